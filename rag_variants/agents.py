@@ -1,53 +1,278 @@
 """Collection of agents for the RAG variants."""
 
+import asyncio
+import contextvars
+import functools
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from bm25_index import BM25Index
+from cache import GraderCache, SqliteCache, content_hash, normalize_text
+from config import (
+    CASCADE_CONFIDENCE_THRESHOLD,
+    CASCADE_SMALL_MODEL,
+    CONTEXT_TOKEN_BUDGET,
+    DOCUMENT_GRADER_MODE,
+    EARLY_EXIT_RELEVANT_DOCS,
+    EARLY_EXIT_RELEVANT_TOKENS,
+    EARLY_EXIT_WAVE_SIZE,
+    GRADER_CACHE_ENABLED,
+    GRADER_CACHE_MAX_ENTRIES,
+    GRADER_CACHE_PATH,
+    GRADER_CACHE_TTL_S,
+    GRADER_CASCADE,
+    GRADER_MAX_CONCURRENCY,
+    INDEX_DIR,
+    MAX_GENERATIONS,
+    MIN_TIME_CHECK_S,
+    MIN_TIME_GRADING_S,
+    MIN_TIME_RETRY_S,
+    NEAR_DUPLICATE_THRESHOLD,
+    PREFILTER_ENABLED,
+    RETRIEVAL_MODE,
+    ROUTER_MODE,
+    ROUTER_VECTORSTORE_THRESHOLD,
+    ROUTER_WEBSEARCH_THRESHOLD,
+    RUN_BUDGET_S,
+    SPECULATIVE_ANSWER_GRADING,
+)
+from context_packing import format_documents, pack_context, rank_documents
+from dedup import remove_near_duplicates
 from grader_prompts import (
+    get_batch_document_grader_prompt,
     get_document_grader_prompt,
     get_hallucination_grader_prompt,
+    get_rag_prompt,
     get_relevance_grader_prompt,
     get_router_prompt,
 )
-from graders import GradeAnswer, GradeDocuments, GradeHallucinations, RouteQuery
+from graders import (
+    GradeAnswer,
+    GradeDocuments,
+    GradeDocumentsBatch,
+    GradeHallucinations,
+    RouteQuery,
+    with_confidence,
+)
 from langchain.schema import Document
+from langchain_core.exceptions import OutputParserException
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda
 from langchain_mistralai import ChatMistralAI
 from loguru import logger
-from tools import web_search_tool
+from prefilter import prefilter_grade
+from streaming import get_token_sink, mark_retry
+from tools import get_web_search_tool
 from vector_store import (
-    create_vector_store_from_web_docs,
+    count_tokens,
+    fill_bm25_index,
     get_retriever,
     get_text_splitter,
+    load_vector_store,
+    open_bm25_index,
 )
 
-from langchain import hub
+_vector_store = None
+# whether the vector store is the persisted index, rather than one set instead
+_is_persisted_index = False
+_vector_store_lock = threading.Lock()
+# runs the relevance grader of speculative answer grading, shared by all runs
+_speculation_executor = ThreadPoolExecutor(thread_name_prefix="speculative-grading")
+
+# number of queries routed by each path of the router
+routing_stats = Counter()
+# number of answers of the small model of each grader cascade, escalated ones
+# and why they were escalated
+cascade_stats = defaultdict(Counter)
+# number of times the deadline or the cap on generations forced a cheaper path
+deadline_stats = Counter()
+# order of the grades of generations, the best one being returned when a run
+# stops before a useful one: grounded ones first, then unchecked ones
+GRADE_RANKS = {"not supported": 0, "unchecked": 1, "not useful": 2, "useful": 3}
+# number of documents graded, left ungraded by early-exit grading, and
+# accepted or rejected by the pre-filter
+grading_stats = Counter()
+
+
+def create_inputs(question: str, budget_s: float = RUN_BUDGET_S) -> dict:
+    """Get the inputs of a run of the graph, with a deadline if there is a budget."""
+    inputs = {"question": question, "generations": 0, "degraded": False}
+    if budget_s:
+        inputs["deadline"] = time.time() + budget_s
+    return inputs
+
+
+def get_remaining_time(state: dict) -> float:
+    """Get the seconds left before the deadline of the run, inf without one."""
+    deadline = state.get("deadline")
+    return math.inf if deadline is None else deadline - time.time()
+
+
+def is_short_of_time(state: dict, needed_s: float, path: str) -> bool:
+    """Check whether the run has less time left than needed.
+
+    If so, the cheaper path the run is forced to take is counted.
+    """
+    remaining = get_remaining_time(state)
+    if remaining >= needed_s:
+        return False
+    deadline_stats[path] += 1
+    logger.warning(f"=== Deadline: {remaining:.1f}s left, {path} ===")
+    return True
+
+
+def set_vector_store(vector_store):
+    """Replace the vector store, e.g. with an in-memory one for offline runs."""
+    global _vector_store, _is_persisted_index
+    with _vector_store_lock:
+        _vector_store = vector_store
+        _is_persisted_index = False
+    get_index_retriever.cache_clear()
+
+
+def get_index_vector_store():
+    """Get the persisted vector store, opening it on first use."""
+    global _vector_store, _is_persisted_index
+    with _vector_store_lock:
+        if _vector_store is None:
+            _vector_store = load_vector_store()
+            _is_persisted_index = True
+    return _vector_store
+
+
+@functools.lru_cache(maxsize=None)
+def get_index_retriever():
+    """Get the retriever over the persisted index, hybrid in the hybrid mode.
+
+    The keyword index of a vector store that was set instead of the
+    persisted one is built in memory.
+    """
+    vector_store = get_index_vector_store()
+    if RETRIEVAL_MODE != "hybrid":
+        return get_retriever(vector_store)
+    bm25_index = (
+        open_bm25_index(INDEX_DIR) if _is_persisted_index else BM25Index(":memory:")
+    )
+    return get_retriever(vector_store, fill_bm25_index(bm25_index, vector_store))
+
+
+@functools.lru_cache(maxsize=None)
+def get_grader_cache() -> GraderCache:
+    """Get the persistent cache of grader verdicts."""
+    store = SqliteCache(
+        GRADER_CACHE_PATH,
+        table="verdicts",
+        max_entries=GRADER_CACHE_MAX_ENTRIES,
+        ttl_seconds=GRADER_CACHE_TTL_S,
+    )
+    return GraderCache(store, enabled=GRADER_CACHE_ENABLED)
+
+
+# The LLM clients and chains below are built once per process and shared by
+# every invocation, so that each model keeps a single pooled HTTP client.
+
 
-urls = [
-    "https://lilianweng.github.io/posts/2023-06-23-agent/",
-    "https://lilianweng.github.io/posts/2023-03-15-prompt-engineering/",
-    "https://lilianweng.github.io/posts/2023-10-25-adv-attack-llm/",
-]
-text_splitter = get_text_splitter()
-vector_store = create_vector_store_from_web_docs(urls, text_splitter)
-retriever = get_retriever(vector_store)
+_llm_factory = ChatMistralAI
 
 
+def set_llm_factory(llm_factory):
+    """Replace the factory of the chat models, e.g. with a fake for offline runs.
+
+    The factory is called with the `model` and `temperature` keyword arguments.
+    """
+    global _llm_factory
+    _llm_factory = llm_factory
+    reset_chains()
+
+
+@functools.lru_cache(maxsize=None)
 def get_mistral_llm(model_name: str = "mistral-large-latest", temp: float = 0.0):
     """Get the LLM."""
-    return ChatMistralAI(model=model_name, temperature=temp)
+    return _llm_factory(model=model_name, temperature=temp)
+
+
+def get_cascade(grader: str, small_chain, large_chain):
+    """Get a chain asking the small model first and the large one if needed.
+
+    The large model is asked when the answer of the small one is malformed
+    or its self-reported confidence is below the threshold.
+    """
+
+    def escalate(output) -> bool:
+        cascade_stats[grader]["small"] += 1
+        if output is None:
+            reason = "malformed"
+        elif output.confidence < CASCADE_CONFIDENCE_THRESHOLD:
+            reason = "low_confidence"
+        else:
+            return False
+        cascade_stats[grader][reason] += 1
+        cascade_stats[grader]["escalated"] += 1
+        logger.info(f"=== Cascade: escalating {grader} grader ({reason}) ===")
+        return True
+
+    def invoke(inputs: dict, config):
+        try:
+            output = small_chain.invoke(inputs, config)
+        except (OutputParserException, ValueError):
+            output = None
+        if escalate(output):
+            return large_chain.invoke(inputs, config)
+        return output
+
+    async def ainvoke(inputs: dict, config):
+        try:
+            output = await small_chain.ainvoke(inputs, config)
+        except (OutputParserException, ValueError):
+            output = None
+        if escalate(output):
+            return await large_chain.ainvoke(inputs, config)
+        return output
+
+    return RunnableLambda(invoke, afunc=ainvoke, name=f"{grader}_cascade")
+
+
+def get_cascade_stats() -> dict:
+    """Get the answers, escalations and escalation rate of each grader cascade."""
+    return {
+        grader: {
+            **counts,
+            "escalation_rate": counts["escalated"] / counts["small"],
+        }
+        for grader, counts in cascade_stats.items()
+        if counts["small"]
+    }
+
+
+def get_structured_chain(grader: str, prompt, schema):
+    """Get the chain of a grader answering with the schema.
+
+    With the cascade enabled, the small model answers first.
+    """
+    # LLM with function call
+    large_chain = prompt | get_mistral_llm().with_structured_output(schema)
+    if not GRADER_CASCADE:
+        return large_chain
 
+    small_llm = get_mistral_llm(CASCADE_SMALL_MODEL)
+    small_chain = prompt | small_llm.with_structured_output(with_confidence(schema))
+    return get_cascade(grader, small_chain, large_chain)
 
+
+@functools.lru_cache(maxsize=None)
 def get_rag_chain():
     """Get the RAG chain."""
-    prompt = hub.pull("rlm/rag-prompt")
+    prompt = ChatPromptTemplate.from_messages([("human", get_rag_prompt())])
     return prompt | get_mistral_llm() | StrOutputParser()
 
 
+@functools.lru_cache(maxsize=None)
 def get_query_router():
     """Get a query router."""
-    # LLM with function call
-    llm = get_mistral_llm()
-    structured_llm_grader = llm.with_structured_output(RouteQuery)
-
     # prompt
     system = get_router_prompt()
 
@@ -57,16 +282,13 @@ def get_query_router():
             ("human", "{question}"),
         ]
     )
-    return query_router_prompt | structured_llm_grader
+    return get_structured_chain("router", query_router_prompt, RouteQuery)
 
 
+@functools.lru_cache(maxsize=None)
 def get_document_grader():
     """Get a retrieval grader."""
 
-    # LLM with function call
-    llm = get_mistral_llm()
-    structured_llm_grader = llm.with_structured_output(GradeDocuments)
-
     # prompt
     system = get_document_grader_prompt()
 
@@ -79,15 +301,31 @@ def get_document_grader():
             ),
         ]
     )
-    return grade_prompt | structured_llm_grader
+    return get_structured_chain("document", grade_prompt, GradeDocuments)
+
+
+@functools.lru_cache(maxsize=None)
+def get_batch_document_grader():
+    """Get a retrieval grader that grades all the documents in one call."""
+
+    # prompt
+    system = get_batch_document_grader_prompt()
+
+    grade_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", system),
+            (
+                "human",
+                "Retrieved documents: \n\n {documents} \n\n User question: {question}",
+            ),
+        ]
+    )
+    return get_structured_chain("batch_document", grade_prompt, GradeDocumentsBatch)
 
 
+@functools.lru_cache(maxsize=None)
 def get_hallucination_grader():
     """Get a hallucination grader."""
-    # LLM with function call
-    llm = get_mistral_llm()
-    structured_llm_grader = llm.with_structured_output(GradeHallucinations)
-
     # prompt
     system = get_hallucination_grader_prompt()
 
@@ -100,15 +338,14 @@ def get_hallucination_grader():
             ),
         ]
     )
-    return hallucination_prompt | structured_llm_grader
+    return get_structured_chain(
+        "hallucination", hallucination_prompt, GradeHallucinations
+    )
 
 
+@functools.lru_cache(maxsize=None)
 def get_relevance_grader():
     """Get a grader for relevance of answers against questions."""
-    # LLM with function call
-    llm = get_mistral_llm()
-    structured_llm_grader = llm.with_structured_output(GradeAnswer)
-
     # prompt
     system = get_relevance_grader_prompt()
 
@@ -122,7 +359,53 @@ def get_relevance_grader():
         ]
     )
 
-    return relevance_prompt | structured_llm_grader
+    return get_structured_chain("relevance", relevance_prompt, GradeAnswer)
+
+
+def reset_chains():
+    """Drop the memoized LLM clients and chains so they are built again."""
+    for getter in (
+        get_mistral_llm,
+        get_rag_chain,
+        get_query_router,
+        get_document_grader,
+        get_batch_document_grader,
+        get_hallucination_grader,
+        get_relevance_grader,
+    ):
+        getter.cache_clear()
+
+
+def route_query_locally(question: str) -> str | None:
+    """Route the query by its similarity to the index, None when it is ambiguous."""
+    docs_and_scores = get_index_vector_store().similarity_search_with_relevance_scores(
+        question, k=1
+    )
+    return decide_route_from_scores(docs_and_scores)
+
+
+async def aroute_query_locally(question: str) -> str | None:
+    """Route the query by its similarity to the index, None when it is ambiguous."""
+    vector_store = await asyncio.to_thread(get_index_vector_store)
+    docs_and_scores = await vector_store.asimilarity_search_with_relevance_scores(
+        question, k=1
+    )
+    return decide_route_from_scores(docs_and_scores)
+
+
+def decide_route_from_scores(docs_and_scores: list) -> str | None:
+    """Decide the route from the best match in the index, None when it is ambiguous."""
+    if not docs_and_scores:
+        return None
+
+    score = docs_and_scores[0][1]
+    logger.info(f"=== Local router: max similarity to the index {score:.3f} ===")
+
+    if score >= ROUTER_VECTORSTORE_THRESHOLD:
+        return "vectorstore"
+    if score <= ROUTER_WEBSEARCH_THRESHOLD:
+        return "websearch"
+    return None
 
 
 def route_query(state: dict) -> str:
@@ -130,13 +413,41 @@ def route_query(state: dict) -> str:
     logger.info("=== Route Query ===")
 
     question = state["question"]
-    query_router = get_query_router()
-    answer_source = query_router.invoke({"question": question})
 
-    if answer_source.data_source.value == "vectorstore":
+    if ROUTER_MODE == "local":
+        data_source = route_query_locally(question)
+        if data_source is not None:
+            return log_route(data_source, "local")
+
+    answer_source = get_query_router().invoke({"question": question})
+    return log_route(answer_source.data_source.value, "llm")
+
+
+async def aroute_query(state: dict) -> str:
+    """Route the query to either web search or RAG."""
+    logger.info("=== Route Query ===")
+
+    question = state["question"]
+
+    if ROUTER_MODE == "local":
+        data_source = await aroute_query_locally(question)
+        if data_source is not None:
+            return log_route(data_source, "local")
+
+    answer_source = await get_query_router().ainvoke({"question": question})
+    return log_route(answer_source.data_source.value, "llm")
+
+
+def log_route(data_source: str, path: str) -> str:
+    """Count the path that routed the query, and log the route it took."""
+    routing_stats[path] += 1
+    if path == "local":
+        logger.info("=== Routed locally, skipped the LLM router ===")
+
+    if data_source == "vectorstore":
         logger.info("=== Route query to RAG ===")
         return "vectorstore"
-    elif answer_source.data_source.value == "websearch":
+    elif data_source == "websearch":
         logger.info("=== Route query to Web Search ===")
         return "websearch"
 
@@ -146,42 +457,345 @@ def retrieve(state: dict) -> dict:
     logger.info("=== Retrieve ===")
 
     question = state["question"]
-    documents = retriever.invoke(question)
+    documents = get_index_retriever().invoke(question)
+
+    return {"documents": documents, "question": question}
+
+
+async def aretrieve(state: dict) -> dict:
+    """Retrieve documents from a vectordb"""
+    logger.info("=== Retrieve ===")
+
+    question = state["question"]
+    retriever = await asyncio.to_thread(get_index_retriever)
+    documents = await retriever.ainvoke(question)
 
     return {"documents": documents, "question": question}
 
 
+def pack_and_report_context(documents: list):
+    """Pack the documents into the context of the generator and log what was dropped."""
+    packed = pack_context(documents, CONTEXT_TOKEN_BUDGET, NEAR_DUPLICATE_THRESHOLD)
+    logger.info(
+        f"=== Packed {len(packed.documents)} documents, {packed.tokens} tokens, "
+        f"dropped {len(packed.dropped)} ==="
+    )
+    for dropped in packed.dropped:
+        logger.debug(f"Dropped from the context: {dropped}")
+    return packed
+
+
+def get_generation_update(state: dict, packed, generation: str) -> dict:
+    """Get the update of the state by a generation from the packed context."""
+    return {
+        "generation": generation,
+        "documents": packed.documents,
+        "question": state["question"],
+        "context_report": packed.report(),
+        "generations": state.get("generations", 0) + 1,
+    }
+
+
 def generate(state: dict) -> dict:
     """Generate an answer from a generator."""
     logger.info("=== Generate ===")
 
-    documents = state["documents"]
-    question = state["question"]
+    packed = pack_and_report_context(state["documents"])
     rag_chain = get_rag_chain()
+    inputs = {"context": packed.text, "question": state["question"]}
 
-    generation = rag_chain.invoke({"context": documents, "question": question})
+    sink = get_token_sink()
+    if sink is None:
+        generation = rag_chain.invoke(inputs)
+    else:
+        tokens = []
+        for token in rag_chain.stream(inputs):
+            sink.token(token)
+            tokens.append(token)
+        generation = "".join(tokens)
 
-    return {"generation": generation, "documents": documents, "question": question}
+    return get_generation_update(state, packed, generation)
 
 
-def grade_documents(state: dict) -> dict:
-    """Grade documents."""
-    logger.info("=== Grade Documents ===")
+async def agenerate(state: dict) -> dict:
+    """Generate an answer from a generator."""
+    logger.info("=== Generate ===")
+
+    # packing counts tokens and hashes shingles, off the event loop
+    packed = await asyncio.to_thread(pack_and_report_context, state["documents"])
+    rag_chain = get_rag_chain()
+    inputs = {"context": packed.text, "question": state["question"]}
+
+    sink = get_token_sink()
+    if sink is None:
+        generation = await rag_chain.ainvoke(inputs)
+    else:
+        tokens = []
+        async for token in rag_chain.astream(inputs):
+            sink.token(token)
+            tokens.append(token)
+        generation = "".join(tokens)
+
+    return get_generation_update(state, packed, generation)
+
+
+# The graders below are written once as steps: a generator that reads the
+# caches, yields what the LLM has to grade and receives its answer, and
+# returns the grades. `run_steps` and `arun_steps` answer the steps with the
+# sync or async LLM call, so the two graphs share the grading logic.
+
+
+def advance(steps, answer=None) -> tuple[bool, object]:
+    """Send the answer to the steps and get (done, their next request or result)."""
+    try:
+        return False, steps.send(answer)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+def run_steps(steps, call):
+    """Run the steps of a grading, answering each request with `call`."""
+    done, value = advance(steps)
+    while not done:
+        done, value = advance(steps, call(value))
+    return value
+
+
+async def arun_steps(steps, acall):
+    """Run the steps of a grading, answering each request with `acall`.
+
+    The steps read and write the SQLite caches and count tokens, so they run
+    in a thread, off the event loop.
+    """
+    done, value = await asyncio.to_thread(advance, steps)
+    while not done:
+        answer = await acall(value)
+        done, value = await asyncio.to_thread(advance, steps, answer)
+    return value
+
+
+def get_document_grader_inputs(question: str, documents: list) -> list[dict]:
+    """Get the inputs of the document grader, one per document."""
+    return [{"question": question, "document": doc.page_content} for doc in documents]
+
+
+def grade_each_document(question: str, documents: list) -> list[str]:
+    """Grade the documents with one grader call per document."""
+    document_grader = get_document_grader()
+
+    # score the docs concurrently, the scores keep the order of the docs
+    scores = document_grader.batch(
+        get_document_grader_inputs(question, documents),
+        config={"max_concurrency": GRADER_MAX_CONCURRENCY},
+    )
+
+    return [score.binary_score for score in scores]
 
-    documents = state["documents"]
-    question = state["question"]
 
+async def agrade_each_document(question: str, documents: list) -> list[str]:
+    """Grade the documents with one grader call per document."""
     document_grader = get_document_grader()
 
-    # score each doc
+    # score the docs concurrently, the scores keep the order of the docs
+    scores = await document_grader.abatch(
+        get_document_grader_inputs(question, documents),
+        config={"max_concurrency": GRADER_MAX_CONCURRENCY},
+    )
+
+    return [score.binary_score for score in scores]
+
+
+def number_documents(documents: list) -> str:
+    """Join the documents into one text where each one is tagged with its index.
+
+    The tags cannot be confused with the numbered references of the pages,
+    and tags in the content itself are defused.
+    """
+    return "\n\n".join(
+        f"<doc id={i}>\n{defuse_doc_tags(doc.page_content)}\n</doc>"
+        for i, doc in enumerate(documents)
+    )
+
+
+def defuse_doc_tags(text: str) -> str:
+    """Break the document tags in a text, so that only ours delimit documents."""
+    return text.replace("<doc", "< doc").replace("</doc", "< /doc")
+
+
+def get_grades_from_verdicts(scores: GradeDocumentsBatch, num_documents: int) -> list:
+    """Get the grade of each document from the batch verdicts, None if missing.
+
+    Verdicts for indices out of range and repeated verdicts are ignored.
+    """
+    grades = {}
+    for verdict in scores.verdicts:
+        if verdict.index not in range(num_documents) or verdict.index in grades:
+            logger.warning(f"Ignored verdict for document {verdict.index}")
+            continue
+        grades[verdict.index] = verdict.binary_score
+    missing = [i for i in range(num_documents) if i not in grades]
+    if missing:
+        logger.warning(f"No verdict for documents {missing}")
+
+    return [grades.get(i) for i in range(num_documents)]
+
+
+def grade_documents_in_batch(question: str, documents: list) -> list[str]:
+    """Grade the documents with a single grader call for all of them."""
+    if not documents:
+        return []
+
+    document_grader = get_batch_document_grader()
+    scores = document_grader.invoke(
+        {"question": question, "documents": number_documents(documents)}
+    )
+
+    return get_grades_from_verdicts(scores, len(documents))
+
+
+async def agrade_documents_in_batch(question: str, documents: list) -> list[str]:
+    """Grade the documents with a single grader call for all of them."""
+    if not documents:
+        return []
+
+    document_grader = get_batch_document_grader()
+    scores = await document_grader.ainvoke(
+        {"question": question, "documents": number_documents(documents)}
+    )
+
+    return get_grades_from_verdicts(scores, len(documents))
+
+
+def get_document_grader_prompt_for_mode() -> str:
+    """Get the prompt of the document grader in the configured mode."""
+    if DOCUMENT_GRADER_MODE == "batch":
+        return get_batch_document_grader_prompt()
+    return get_document_grader_prompt()
+
+
+def get_prefilter_grades(question: str, documents: list) -> list:
+    """Get the grade of each clear-cut document, None for the uncertain ones."""
+    if not PREFILTER_ENABLED:
+        return [None] * len(documents)
+
+    grades = [prefilter_grade(question, doc) for doc in documents]
+    grading_stats["prefilter_accepted"] += grades.count("yes")
+    grading_stats["prefilter_rejected"] += grades.count("no")
+    avoided = len(grades) - grades.count(None)
+    logger.info(f"=== Pre-filter: graded {avoided}/{len(grades)} without the LLM ===")
+    return grades
+
+
+def get_cached_document_grades(question: str, documents: list) -> list:
+    """Get the grade of each document from the pre-filter or the cache.
+
+    The grade is None for the documents that the LLM grader has to grade.
+    """
+    cache = get_grader_cache()
+    prompt = get_document_grader_prompt_for_mode()
+    return [
+        grade or cache.get("document", question, doc.page_content, prompt)
+        for doc, grade in zip(documents, get_prefilter_grades(question, documents))
+    ]
+
+
+def update_document_grades(
+    question: str, documents: list, grades: list, misses: list[int], new_grades: list
+):
+    """Fill in and cache the grades of the documents that were not in the cache."""
+    cache = get_grader_cache()
+    prompt = get_document_grader_prompt_for_mode()
+    for i, grade in zip(misses, new_grades):
+        if grade is None:  # no verdict, grade as not relevant without caching
+            grades[i] = "no"
+            continue
+        grades[i] = grade.lower()
+        cache.set("document", question, documents[i].page_content, prompt, grades[i])
+
+
+def grade_documents_with_cache(question: str, documents: list):
+    """Steps grading the documents, asking the grader only for uncached verdicts.
+
+    Yields the documents to grade and receives their grades.
+    """
+    grades = get_cached_document_grades(question, documents)
+    misses = [i for i, grade in enumerate(grades) if grade is None]
+
+    if misses:
+        new_grades = yield [documents[i] for i in misses]
+        update_document_grades(question, documents, grades, misses, new_grades)
+
+    return grades
+
+
+def get_grading_order(documents: list) -> list[int]:
+    """Get the indices of the documents by retrieval score, best first."""
+    positions = {id(doc): i for i, doc in enumerate(documents)}
+    return [positions[id(doc)] for doc in rank_documents(documents)]
+
+
+def has_enough_relevant(documents: list, grades: list, graded: list[int]) -> bool:
+    """Check whether the graded documents hold enough relevant context to stop."""
+    relevant = [i for i in graded if grades[i] == "yes"]
+    if EARLY_EXIT_RELEVANT_DOCS and len(relevant) >= EARLY_EXIT_RELEVANT_DOCS:
+        return True
+    tokens = sum(count_tokens(documents[i].page_content) for i in relevant)
+    return bool(EARLY_EXIT_RELEVANT_TOKENS) and tokens >= EARLY_EXIT_RELEVANT_TOKENS
+
+
+def mark_ungraded(grades: list, graded: list[int]) -> list[str]:
+    """Grade the documents left when grading stopped early as ungraded."""
+    graded = set(graded)
+    grading_stats["graded"] += len(graded)
+    grading_stats["ungraded"] += len(grades) - len(graded)
+    return [grade if i in graded else "ungraded" for i, grade in enumerate(grades)]
+
+
+def grade_documents_early_exit(question: str, documents: list):
+    """Steps grading the documents by retrieval score until enough are relevant.
+
+    The documents are graded in waves of `EARLY_EXIT_WAVE_SIZE`: each wave
+    yields the documents to grade and receives their grades. The ones left
+    when grading stops are graded as ungraded.
+    """
+    grades = get_cached_document_grades(question, documents)
+    order = get_grading_order(documents)
+    graded = []
+    for start in range(0, len(order), EARLY_EXIT_WAVE_SIZE):
+        if has_enough_relevant(documents, grades, graded):
+            break
+        wave = order[start : start + EARLY_EXIT_WAVE_SIZE]
+        misses = [i for i in wave if grades[i] is None]
+        if misses:
+            new_grades = yield [documents[i] for i in misses]
+            update_document_grades(question, documents, grades, misses, new_grades)
+        graded.extend(wave)
+
+    return mark_ungraded(grades, graded)
+
+
+def get_document_grading_steps(question: str, documents: list):
+    """Get the steps grading the documents in the configured mode."""
+    if DOCUMENT_GRADER_MODE == "early_exit":
+        return grade_documents_early_exit(question, documents)
+    return grade_documents_with_cache(question, documents)
+
+
+def filter_graded_documents(state: dict, grades: list[str]) -> dict:
+    """Keep the relevant documents and flag a web search if any is not relevant.
+
+    Ungraded documents are dropped without flagging a web search, as enough
+    relevant documents were found before them.
+    """
+    documents = state["documents"]
+    question = state["question"]
+
     filtered_docs = []
     web_search = "No"
-    for doc in documents:
-        score = document_grader.invoke(
-            {"question": question, "document": doc.page_content}
-        )
-        grade = score.binary_score
-
+    for doc, grade in zip(documents, grades):
+        if grade == "ungraded":
+            logger.info("=== GRADE: Document not graded ===")
+            continue
         if grade.lower() == "yes":  # Document is relevant
             logger.info("=== GRADE: Relevant Document ===")
             filtered_docs.append(doc)
@@ -193,23 +807,139 @@ def grade_documents(state: dict) -> dict:
     return {"documents": filtered_docs, "question": question, "web_search": web_search}
 
 
+def skip_grading(state: dict) -> dict:
+    """Keep the documents ungraded, without a web search."""
+    return {
+        "documents": state["documents"],
+        "question": state["question"],
+        "web_search": "No",
+    }
+
+
+def grade_documents(state: dict) -> dict:
+    """Grade documents."""
+    logger.info("=== Grade Documents ===")
+
+    if is_short_of_time(state, MIN_TIME_GRADING_S, "skip_grading"):
+        return skip_grading(state)
+
+    question = state["question"]
+    steps = get_document_grading_steps(question, state["documents"])
+    grade_fn = (
+        grade_documents_in_batch
+        if DOCUMENT_GRADER_MODE == "batch"
+        else grade_each_document
+    )
+    grades = run_steps(steps, functools.partial(grade_fn, question))
+
+    return filter_graded_documents(state, grades)
+
+
+async def agrade_documents(state: dict) -> dict:
+    """Grade documents."""
+    logger.info("=== Grade Documents ===")
+
+    if is_short_of_time(state, MIN_TIME_GRADING_S, "skip_grading"):
+        return skip_grading(state)
+
+    question = state["question"]
+    steps = get_document_grading_steps(question, state["documents"])
+    agrade_fn = (
+        agrade_documents_in_batch
+        if DOCUMENT_GRADER_MODE == "batch"
+        else agrade_each_document
+    )
+    grades = await arun_steps(steps, functools.partial(agrade_fn, question))
+
+    return filter_graded_documents(state, grades)
+
+
+def fit_token_budget(documents: list, new_documents: list, budget: int) -> list:
+    """Add the new documents in order while the total stays within the budget."""
+    total = sum(count_tokens(doc.page_content) for doc in documents)
+    fitted = []
+    for doc in new_documents:
+        tokens = count_tokens(doc.page_content)
+        if total + tokens > budget:
+            continue
+        total += tokens
+        fitted.append(doc)
+    return fitted
+
+
+def add_web_results(state: dict, docs_from_search: list) -> dict:
+    """Add the web search results to the documents.
+
+    The results are split like the indexed documents, chunks that nearly
+    duplicate a document already in the state are dropped, and the rest
+    are added as long as the context stays within the token budget.
+    """
+    question = state["question"]
+    documents = state.get("documents") or []
+
+    web_docs = [
+        Document(page_content=doc["content"], metadata={"source": doc.get("url")})
+        for doc in docs_from_search
+    ]
+    web_chunks = get_text_splitter().split_documents(web_docs)
+    new_chunks = remove_near_duplicates(
+        web_chunks, documents, threshold=NEAR_DUPLICATE_THRESHOLD
+    )
+    fitted_chunks = fit_token_budget(documents, new_chunks, CONTEXT_TOKEN_BUDGET)
+    logger.info(
+        f"=== Web search: {len(web_chunks)} chunks, "
+        f"{len(web_chunks) - len(new_chunks)} near-duplicates, "
+        f"{len(new_chunks) - len(fitted_chunks)} over the token budget ==="
+    )
+
+    searched_queries = (state.get("searched_queries") or []) + [
+        normalize_text(question)
+    ]
+
+    return {
+        "documents": documents + fitted_chunks,
+        "question": question,
+        "searched_queries": searched_queries,
+    }
+
+
+def is_searched_in_run(state: dict) -> bool:
+    """Check whether the question was already searched in this run of the graph.
+
+    The results of that search are still in the documents, so they are not
+    fetched and added again.
+    """
+    searched = normalize_text(state["question"]) in (
+        state.get("searched_queries") or []
+    )
+    if searched:
+        logger.info("=== Web search already done in this run, skipped ===")
+    return searched
+
+
 def web_search(state: dict) -> dict:
     """Perform a web search."""
     logger.info("=== Web Search ===")
 
-    question = state["question"]
-    documents = state["documents"]
+    if is_searched_in_run(state):
+        return {"documents": state["documents"], "question": state["question"]}
 
-    docs_from_search = web_search_tool.invoke({"query": question})
-    web_results = "\n".join([doc["content"] for doc in docs_from_search])
-    web_results = Document(page_content=web_results)
+    docs_from_search = get_web_search_tool().invoke({"query": state["question"]})
 
-    if documents is not None:
-        documents.append(web_results)
-    else:
-        documents = [web_results]
+    return add_web_results(state, docs_from_search)
 
-    return {"documents": documents, "question": question}
+
+async def aweb_search(state: dict) -> dict:
+    """Perform a web search."""
+    logger.info("=== Web Search ===")
+
+    if is_searched_in_run(state):
+        return {"documents": state["documents"], "question": state["question"]}
+
+    docs_from_search = await get_web_search_tool().ainvoke({"query": state["question"]})
+
+    # splitting, MinHash and token counts, off the event loop
+    return await asyncio.to_thread(add_web_results, state, docs_from_search)
 
 
 def decide_to_generate(state: dict) -> str:
@@ -221,48 +951,251 @@ def decide_to_generate(state: dict) -> str:
     filtered_documents = state["documents"]
 
     if web_search == "Yes":
-        logger.info(
-            "=== Decision: All Documents are not relevant, include Web Search ==="
-        )
-        return "websearch"
+        if not filtered_documents or not is_short_of_time(
+            state, MIN_TIME_RETRY_S, "skip_websearch"
+        ):
+            logger.info(
+                "=== Decision: All Documents are not relevant, include Web Search ==="
+            )
+            return "websearch"
+        logger.info("=== Decision: Generate from the relevant documents ===")
+        return "generate"
     else:
         logger.info("=== Decision: Generate ===")
         return "generate"
 
 
+def get_hallucination_content(documents: list, generation: str) -> str:
+    """Get the content graded by the hallucination grader, for the cache key.
+
+    The documents and the generation are hashed apart, so that no other
+    split of the same text gets the same key.
+    """
+    return f"{content_hash(format_documents(documents))}:{content_hash(generation)}"
+
+
+def grade_with_cache(grader: str, question: str, content: str, prompt: str, inputs):
+    """Steps grading the content, asking the grader only if it is not in the cache.
+
+    Yields the inputs of the grader and receives its score.
+    """
+    cache = get_grader_cache()
+    grade = cache.get(grader, question, content, prompt)
+    if grade is None:
+        score = yield inputs
+        grade = score.binary_score.lower()
+        cache.set(grader, question, content, prompt, grade)
+
+    return grade
+
+
+def grade_hallucinations_steps(question: str, documents: list, generation: str):
+    """Steps grading whether the generation is grounded in the documents."""
+    return (
+        yield from grade_with_cache(
+            "hallucination",
+            question,
+            get_hallucination_content(documents, generation),
+            get_hallucination_grader_prompt(),
+            {"documents": format_documents(documents), "generation": generation},
+        )
+    )
+
+
+def grade_relevance_steps(question: str, generation: str):
+    """Steps grading whether the generation addresses the question."""
+    return (
+        yield from grade_with_cache(
+            "relevance",
+            question,
+            generation,
+            get_relevance_grader_prompt(),
+            {"question": question, "generation": generation},
+        )
+    )
+
+
+def grade_hallucinations(question: str, documents: list, generation: str) -> str:
+    """Grade whether the generation is grounded in the documents."""
+    steps = grade_hallucinations_steps(question, documents, generation)
+    return run_steps(steps, get_hallucination_grader().invoke)
+
+
+async def agrade_hallucinations(question: str, documents: list, generation: str) -> str:
+    """Grade whether the generation is grounded in the documents."""
+    steps = grade_hallucinations_steps(question, documents, generation)
+    return await arun_steps(steps, get_hallucination_grader().ainvoke)
+
+
+def grade_relevance(question: str, generation: str) -> str:
+    """Grade whether the generation addresses the question."""
+    steps = grade_relevance_steps(question, generation)
+    return run_steps(steps, get_relevance_grader().invoke)
+
+
+async def agrade_relevance(question: str, generation: str) -> str:
+    """Grade whether the generation addresses the question."""
+    steps = grade_relevance_steps(question, generation)
+    return await arun_steps(steps, get_relevance_grader().ainvoke)
+
+
 def check_for_hallucinations_and_relevance(state: dict) -> str:
-    """Check for hallucinations and relevance."""
+    """Check for hallucinations and relevance.
+
+    Returns the grade of the generation: "useful", "not useful", "not
+    supported", or "unchecked" when there is no time left to check it.
+    """
     logger.info("=== Check for Hallucinations ===")
 
     question = state["question"]
     generation = state["generation"]
     documents = state["documents"]
 
-    hallucination_grader = get_hallucination_grader()
-    relevance_grader = get_relevance_grader()
+    if is_short_of_time(state, MIN_TIME_CHECK_S, "skip_check"):
+        return "unchecked"
 
-    hallucination_score = hallucination_grader.invoke(
-        {"documents": documents, "generation": generation}
-    )
-    grade = hallucination_score.binary_score
+    if SPECULATIVE_ANSWER_GRADING:
+        # grade relevance while grading hallucinations, the relevance
+        # grade is discarded if the answer turns out not to be grounded
+        relevance_future = _speculation_executor.submit(
+            contextvars.copy_context().run, grade_relevance, question, generation
+        )
+        try:
+            grade = grade_hallucinations(question, documents, generation)
+        except Exception:
+            relevance_future.cancel()
+            raise
+    else:
+        relevance_future = None
+        grade = grade_hallucinations(question, documents, generation)
+
+    if not is_grounded(grade):
+        if relevance_future is not None:
+            relevance_future.cancel()
+        return "not supported"
 
+    if relevance_future is not None:
+        grade = relevance_future.result()
+    else:
+        grade = grade_relevance(question, generation)
+    return get_relevance_verdict(grade)
+
+
+async def acheck_for_hallucinations_and_relevance(state: dict) -> str:
+    """Check for hallucinations and relevance.
+
+    Returns the grade of the generation, as
+    `check_for_hallucinations_and_relevance` does.
+    """
+    logger.info("=== Check for Hallucinations ===")
+
+    question = state["question"]
+    generation = state["generation"]
+    documents = state["documents"]
+
+    if is_short_of_time(state, MIN_TIME_CHECK_S, "skip_check"):
+        return "unchecked"
+
+    if SPECULATIVE_ANSWER_GRADING:
+        # grade relevance while grading hallucinations, the relevance
+        # grade is discarded if the answer turns out not to be grounded
+        relevance_task = asyncio.create_task(agrade_relevance(question, generation))
+        try:
+            grade = await agrade_hallucinations(question, documents, generation)
+        except Exception:
+            relevance_task.cancel()
+            raise
+    else:
+        relevance_task = None
+        grade = await agrade_hallucinations(question, documents, generation)
+
+    if not is_grounded(grade):
+        if relevance_task is not None:
+            relevance_task.cancel()
+        return "not supported"
+
+    if relevance_task is not None:
+        grade = await relevance_task
+    else:
+        grade = await agrade_relevance(question, generation)
+    return get_relevance_verdict(grade)
+
+
+def is_grounded(grade: str) -> bool:
+    """Check whether the hallucination grade says the answer is grounded."""
     if grade.lower() == "yes":  # Answer is grounded
         logger.info("=== DECISION: Answer is grounded IN DOCUMENTS ===")
         logger.info("=== GRADE ANSWER FOR RELEVANCE TO QUESTION ===")
-        score = relevance_grader.invoke(
-            {"question": question, "generation": generation}
-        )
-        grade = score.binary_score
+        return True
+    logger.info("=== DECISION: Answer is not grounded in documents, Re-try ===")
+    return False
 
-        if grade.lower() == "yes":
-            logger.info("=== DECISION: Answer is relevant to the question ===")
-            return "useful"
-        else:
-            logger.info("=== DECISION: Answer is not relevant to the question ===")
-            return "not useful"
+
+def get_relevance_verdict(grade: str) -> str:
+    """Get whether a grounded answer is useful from its relevance grade."""
+    if grade.lower() == "yes":
+        logger.info("=== DECISION: Answer is relevant to the question ===")
+        return "useful"
     else:
-        logger.info("=== DECISION: Answer is not grounded in documents, Re-try ===")
-        return "not supported"
+        logger.info("=== DECISION: Answer is not relevant to the question ===")
+        return "not useful"
+
+
+def get_generation_grade_update(state: dict, grade: str) -> dict:
+    """Get the update of the state by the grade of the generation.
+
+    The generation becomes the best one so far unless an earlier one has a
+    better grade, a later one winning ties as it had more context.
+    """
+    update = {"generation_grade": grade}
+    best_grade = state.get("best_grade")
+    if best_grade is None or GRADE_RANKS[grade] >= GRADE_RANKS[best_grade]:
+        update["best_generation"] = state["generation"]
+        update["best_grade"] = grade
+    return update
+
+
+def grade_generation(state: dict) -> dict:
+    """Grade the generation, keeping the best one of the run."""
+    grade = check_for_hallucinations_and_relevance(state)
+    return get_generation_grade_update(state, grade)
+
+
+async def agrade_generation(state: dict) -> dict:
+    """Grade the generation, keeping the best one of the run."""
+    grade = await acheck_for_hallucinations_and_relevance(state)
+    return get_generation_grade_update(state, grade)
+
+
+def decide_after_grading(state: dict) -> str:
+    """Decide whether to end with the generation, retry, or stop with the best one."""
+    grade = state["generation_grade"]
+    if grade == "useful":
+        return "useful"
+    if grade == "unchecked":
+        return "stop"
+    return decide_retry(state, grade)
+
+
+def decide_retry(state: dict, reason: str) -> str:
+    """Retry for the reason, or stop with the best answer when out of budget."""
+    if state.get("generations", 0) >= MAX_GENERATIONS:
+        deadline_stats["iteration_cap"] += 1
+        logger.warning(f"=== Deadline: {MAX_GENERATIONS} generations, stop ===")
+        return "stop"
+    if is_short_of_time(state, MIN_TIME_RETRY_S, "stop_retrying"):
+        return "stop"
+
+    mark_retry(reason)
+    return reason
+
+
+def return_best_generation(state: dict) -> dict:
+    """End the run with the best generation so far, flagged as degraded."""
+    logger.warning(
+        f"=== Returning the best generation, graded {state['best_grade']} ==="
+    )
+    return {"generation": state["best_generation"], "degraded": True}
 
 
 def test_agents():
@@ -0,0 +1,60 @@
+"""Compare the throughput of the sync and async graphs against a fake LLM."""
+
+import argparse
+import asyncio
+import time
+
+from agents import create_inputs
+from fakes import use_fakes
+from graph import create_graph_rag_variant
+from loguru import logger
+
+
+def run_sync(questions: list[str]) -> float:
+    """Run the questions one after another through the sync graph."""
+    app = create_graph_rag_variant()
+    start = time.perf_counter()
+    for question in questions:
+        app.invoke(create_inputs(question))
+    return time.perf_counter() - start
+
+
+async def run_async(questions: list[str], concurrency: int) -> float:
+    """Run the questions concurrently through the async graph."""
+    app = create_graph_rag_variant(use_async=True)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(question: str):
+        async with semaphore:
+            await app.ainvoke(create_inputs(question))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_one(question) for question in questions))
+    return time.perf_counter() - start
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--num-questions", type=int, default=20)
+    parser.add_argument("-c", "--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.2, help="Latency of each fake call in s"
+    )
+    args = parser.parse_args()
+
+    logger.remove()
+    use_fakes(args.latency)
+    questions = [f"Question {i} about agent memory?" for i in range(args.num_questions)]
+
+    sync_elapsed = run_sync(questions)
+    async_elapsed = asyncio.run(run_async(questions, args.concurrency))
+
+    print(f"{'graph':<8}{'elapsed (s)':>14}{'questions/s':>14}")
+    for name, elapsed in [("sync", sync_elapsed), ("async", async_elapsed)]:
+        print(f"{name:<8}{elapsed:>14.2f}{len(questions) / elapsed:>14.2f}")
+    print(f"speedup: {sync_elapsed / async_elapsed:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+"""Replay a fixed set of questions through the graph against fakes, offline.
+
+The LLM, the embeddings and the web search are fakes with configurable
+latency distributions and verdict rates, so that the cost of changes to the
+graph can be measured reproducibly and without any API:
+
+    python benchmark_replay.py --llm-latency lognormal:-1.6,0.5 \
+        --yes-rate GradeHallucinations=0.7 --output replay.json
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from pathlib import Path
+
+from agents import create_inputs, deadline_stats, get_index_vector_store
+from fakes import fake_run, use_fakes
+from graph import create_graph_rag_variant
+from instrumentation import RunRecorder, percentile
+from langgraph.errors import GraphRecursionError
+from loguru import logger
+
+QUESTIONS_PATH = Path(__file__).parent / "benchmark_questions.json"
+RECURSION_LIMIT = 25
+
+
+def get_question_result(
+    question: str, recorder: RunRecorder, state: dict | None = None, error=None
+) -> dict:
+    """Get the latency, LLM calls and loop iterations of the run of a question.
+
+    The run is degraded if it stopped with its best answer rather than a
+    useful one.
+    """
+    run = recorder.runs[-1] if recorder.runs else None
+    totals = run.totals() if run else {}
+    node_executions = totals.get("node_executions", {})
+    return {
+        "question": question,
+        "latency": run.wall_time if run else 0.0,
+        "llm_calls": totals.get("llm_calls", 0),
+        "tokens": totals.get("prompt_tokens", 0) + totals.get("completion_tokens", 0),
+        "generations": node_executions.get("generate", 0),
+        "web_searches": node_executions.get("websearch", 0),
+        "degraded": bool(state and state.get("degraded")),
+        "node_executions": node_executions,
+        "error": repr(error) if error else None,
+    }
+
+
+def check_relevance_scores(questions: list[str], k: int = 4):
+    """Check that the fake index scores the questions in [0, 1].
+
+    The thresholds of the local router and the pre-filter assume that
+    scale, so a replay measuring them is meaningless outside it.
+    """
+    vector_store = get_index_vector_store()
+    for question in set(questions):
+        for _, score in vector_store.similarity_search_with_relevance_scores(
+            question, k=k
+        ):
+            assert (
+                -1e-6 <= score <= 1 + 1e-6
+            ), f"Relevance score {score} out of [0, 1] for {question!r}"
+
+
+def run_sync(questions: list[str], budget_s: float) -> list[dict]:
+    """Run the questions one after another through the sync graph."""
+    app = create_graph_rag_variant()
+    results = []
+    for i, question in enumerate(questions):
+        recorder = RunRecorder()
+        config = {"callbacks": [recorder], "recursion_limit": RECURSION_LIMIT}
+        try:
+            with fake_run(f"{i}:{question}"):
+                state = app.invoke(create_inputs(question, budget_s), config)
+            results.append(get_question_result(question, recorder, state))
+        except GraphRecursionError as e:
+            results.append(get_question_result(question, recorder, error=e))
+    return results
+
+
+async def run_async(
+    questions: list[str], concurrency: int, budget_s: float
+) -> list[dict]:
+    """Run the questions concurrently through the async graph."""
+    app = create_graph_rag_variant(use_async=True)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_one(i: int, question: str) -> dict:
+        recorder = RunRecorder()
+        config = {"callbacks": [recorder], "recursion_limit": RECURSION_LIMIT}
+        async with semaphore:
+            try:
+                with fake_run(f"{i}:{question}"):
+                    state = await app.ainvoke(create_inputs(question, budget_s), config)
+                return get_question_result(question, recorder, state)
+            except GraphRecursionError as e:
+                return get_question_result(question, recorder, error=e)
+
+    return await asyncio.gather(
+        *(run_one(i, question) for i, question in enumerate(questions))
+    )
+
+
+def summarize(results: list[dict], elapsed: float) -> dict:
+    """Get the throughput, latency percentiles and mean costs per question."""
+    latencies = [result["latency"] for result in results]
+    count = len(results)
+    return {
+        "questions": count,
+        "elapsed": elapsed,
+        "questions_per_s": count / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "mean_llm_calls": sum(r["llm_calls"] for r in results) / count,
+        "mean_generations": sum(r["generations"] for r in results) / count,
+        "mean_web_searches": sum(r["web_searches"] for r in results) / count,
+        "degraded": sum(r["degraded"] for r in results),
+        "errors": sum(r["error"] is not None for r in results),
+    }
+
+
+def parse_yes_rates(specs: list[str]) -> dict:
+    """Parse `NAME=RATE` pairs into rates of 'yes' verdicts per grader schema."""
+    rates = {}
+    for spec in specs:
+        name, _, rate = spec.partition("=")
+        rates[name] = float(rate)
+    return rates
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--questions", type=Path, default=QUESTIONS_PATH)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Number of times to replay the set"
+    )
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("--sync", action="store_true", help="Use the sync graph")
+    parser.add_argument(
+        "--llm-latency",
+        default="0.2",
+        help="Latency of the fake LLM in s: a number, uniform:a,b, normal:mean,std "
+        "or lognormal:mu,sigma",
+    )
+    parser.add_argument(
+        "--search-latency", default=None, help="Latency of the stub web search"
+    )
+    parser.add_argument(
+        "--yes-rate",
+        action="append",
+        default=[],
+        metavar="NAME=RATE",
+        help="Rate of 'yes' verdicts of a grader schema, e.g. GradeDocuments=0.5, "
+        "or of vectorstore routes for RouteQuery",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.0,
+        help="Deadline of each run in s, 0 for none",
+    )
+    parser.add_argument("--output", type=Path, help="Write the results as JSON")
+    args = parser.parse_args()
+
+    logger.remove()
+    yes_rates = parse_yes_rates(args.yes_rate)
+    use_fakes(args.llm_latency, args.search_latency, yes_rates, args.seed)
+    questions = json.loads(args.questions.read_text()) * args.repeat
+    check_relevance_scores(questions)
+
+    start = time.perf_counter()
+    if args.sync:
+        results = run_sync(questions, args.budget)
+    else:
+        results = asyncio.run(run_async(questions, args.concurrency, args.budget))
+    summary = summarize(results, time.perf_counter() - start)
+
+    print(f"{'questions':<20}{summary['questions']:>10}")
+    print(f"{'questions/s':<20}{summary['questions_per_s']:>10.2f}")
+    print(f"{'p50 (s)':<20}{summary['p50']:>10.3f}")
+    print(f"{'p99 (s)':<20}{summary['p99']:>10.3f}")
+    print(f"{'llm calls/question':<20}{summary['mean_llm_calls']:>10.2f}")
+    print(f"{'generations/question':<20}{summary['mean_generations']:>10.2f}")
+    print(f"{'searches/question':<20}{summary['mean_web_searches']:>10.2f}")
+    print(f"{'degraded answers':<20}{summary['degraded']:>10}")
+    print(f"{'errors':<20}{summary['errors']:>10}")
+    print(f"degraded paths: {dict(deadline_stats)}")
+
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        report = {
+            "settings": {
+                "sync": args.sync,
+                "concurrency": args.concurrency,
+                "llm_latency": args.llm_latency,
+                "search_latency": args.search_latency,
+                "yes_rates": yes_rates,
+                "seed": args.seed,
+                "budget": args.budget,
+            },
+            "summary": summary,
+            "degraded_paths": dict(deadline_stats),
+            "questions": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
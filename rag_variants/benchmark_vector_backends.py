@@ -0,0 +1,190 @@
+"""Compare the Chroma and NumPy vector backends on synthetic embeddings.
+
+Each backend runs in its own process so that its resident memory is measured
+apart. The embeddings are computed before timing, so build time is the time
+the backend takes to store them. The store is built in batches through the
+`ChunkWriter` of the index build, and refreshed by deleting the chunks of some
+pages one page at a time, as `upsert_page` does:
+
+    python benchmark_vector_backends.py -n 50000 --dim 1024 --dtype float16
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from config import EMBEDDING_BATCH_SIZE
+from instrumentation import percentile
+from langchain.schema import Document
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_core.embeddings import Embeddings
+from vector_store import DISTANCE, ChunkWriter
+
+BACKENDS = ["chroma", "numpy"]
+# chunks per synthetic page, and pages deleted by the refresh
+CHUNKS_PER_PAGE = 50
+REFRESH_PAGES = 20
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """Embeddings looked up from a dict, so embedding costs nothing."""
+
+    def __init__(self, vectors: dict[str, list[float]]):
+        self.vectors = vectors
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.vectors[text]
+
+
+def build_store(
+    backend: str, texts: list[str], embeddings, persist_directory: str, dtype: str
+):
+    """Build a persisted store of the texts with the backend, a batch at a time.
+
+    The dtype only applies to the NumPy backend.
+    """
+    if backend == "numpy":
+        from numpy_index import NumpyVectorStore
+
+        store = NumpyVectorStore(persist_directory, embeddings, dtype=dtype)
+    else:
+        from langchain_community.vectorstores import Chroma
+
+        store = Chroma(
+            collection_name="benchmark",
+            embedding_function=embeddings,
+            persist_directory=persist_directory,
+            collection_metadata={"hnsw:space": DISTANCE},
+        )
+
+    writer = ChunkWriter(store, batch_size=EMBEDDING_BATCH_SIZE)
+    for i, text in enumerate(texts):
+        writer.add({str(i): Document(page_content=text)})
+    writer.flush()
+    return store
+
+
+def refresh_store(store, num_chunks: int):
+    """Delete the chunks of the first pages, with one call per page."""
+    for start in range(
+        0, min(num_chunks, REFRESH_PAGES * CHUNKS_PER_PAGE), CHUNKS_PER_PAGE
+    ):
+        store.delete(ids=[str(i) for i in range(start, start + CHUNKS_PER_PAGE)])
+
+
+def run_backend(
+    backend: str, num_chunks: int, num_queries: int, dim: int, k: int, dtype: str
+):
+    """Benchmark one backend and print the results as JSON."""
+    texts = [f"Chunk {i} of the synthetic corpus." for i in range(num_chunks)]
+    queries = [f"Query {i} about the synthetic corpus?" for i in range(num_queries)]
+    fake = DeterministicFakeEmbedding(size=dim)
+    embeddings = PrecomputedEmbeddings(
+        dict(zip(texts + queries, fake.embed_documents(texts + queries)))
+    )
+
+    with tempfile.TemporaryDirectory() as persist_directory:
+        start = time.perf_counter()
+        store = build_store(backend, texts, embeddings, persist_directory, dtype)
+        build_time = time.perf_counter() - start
+
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            store.similarity_search_with_relevance_scores(query, k=k)
+            latencies.append(time.perf_counter() - start)
+
+        batch_time = None
+        if backend == "numpy":
+            start = time.perf_counter()
+            store.batch_similarity_search_with_score(queries, k=k)
+            batch_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        refresh_store(store, num_chunks)
+        refresh_time = time.perf_counter() - start
+
+        print(
+            json.dumps(
+                {
+                    "backend": backend,
+                    "build_s": build_time,
+                    "refresh_s": refresh_time,
+                    "query_p50_ms": percentile(latencies, 50) * 1000,
+                    "query_p95_ms": percentile(latencies, 95) * 1000,
+                    "batch_per_query_ms": (
+                        batch_time / num_queries * 1000 if batch_time else None
+                    ),
+                    # ru_maxrss is in KiB on Linux
+                    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                    / 1024,
+                }
+            )
+        )
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-n", "--num-chunks", type=int, default=20000)
+    parser.add_argument("-q", "--num-queries", type=int, default=200)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("-k", type=int, default=4)
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float16"],
+        default="float32",
+        help="Dtype of the NumPy matrix",
+    )
+    parser.add_argument("--backend", choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.backend:
+        run_backend(
+            args.backend,
+            args.num_chunks,
+            args.num_queries,
+            args.dim,
+            args.k,
+            args.dtype,
+        )
+        return
+
+    results = []
+    for backend in BACKENDS:
+        output = subprocess.run(
+            [sys.executable, __file__, "--backend", backend]
+            + ["-n", str(args.num_chunks), "-q", str(args.num_queries)]
+            + ["--dim", str(args.dim), "-k", str(args.k), "--dtype", args.dtype],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"NumPy matrix: {args.dtype}")
+    print(
+        f"{'backend':<8}{'build (s)':>11}{'refresh (s)':>13}{'p50 (ms)':>10}"
+        f"{'p95 (ms)':>10}"
+        f"{'batch (ms/q)':>14}{'max rss (MB)':>14}"
+    )
+    for r in results:
+        batch = f"{r['batch_per_query_ms']:.3f}" if r["batch_per_query_ms"] else "-"
+        print(
+            f"{r['backend']:<8}{r['build_s']:>11.2f}{r['refresh_s']:>13.2f}"
+            f"{r['query_p50_ms']:>10.3f}{r['query_p95_ms']:>10.3f}{batch:>14}"
+            f"{r['max_rss_mb']:>14.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
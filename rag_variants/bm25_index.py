@@ -0,0 +1,179 @@
+"""A persisted inverted index over the chunks, searched with BM25."""
+
+import json
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from pathlib import Path
+
+from langchain.schema import Document
+
+# words, keeping model names and versions such as gpt-4 or llama-2.1 whole
+_TOKEN = re.compile(r"\w+(?:[-.]\w+)*")
+
+# words too common to tell documents apart, whose postings hold nearly every
+# chunk
+STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from has have how i in is it its "
+    "me my of on or that the their them there these this to was what when where "
+    "which who why will with you your".split()
+)
+
+# version of the terms and statistics, an index of another version is emptied
+SCHEMA_VERSION = 2
+
+
+def tokenize(text: str) -> list[str]:
+    """Split a text into lowercase terms, stopwords aside."""
+    return [term for term in _TOKEN.findall(text.lower()) if term not in STOPWORDS]
+
+
+class BM25Index:
+    """An inverted index in SQLite, updated chunk by chunk and searched with BM25.
+
+    The number of chunks and their total length are kept up to date by
+    `add` and `delete`, so a search only reads the postings of its terms.
+    The index is safe to share between threads. Use ":memory:" as the path
+    for an index that is not persisted.
+    """
+
+    def __init__(self, path: Path | str, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id TEXT PRIMARY KEY, content TEXT, metadata TEXT, length INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT, id TEXT, tf INTEGER, PRIMARY KEY (term, id))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_id ON postings (id)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL)"
+        )
+        stats = dict(self._conn.execute("SELECT name, value FROM stats").fetchall())
+        if stats.get("version") != SCHEMA_VERSION:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM postings")
+            stats = {"version": SCHEMA_VERSION, "num_docs": 0, "total_length": 0}
+        self._num_docs = int(stats["num_docs"])
+        self._total_length = int(stats["total_length"])
+        self._write_stats()
+        self._conn.commit()
+
+    def _write_stats(self):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO stats VALUES (?, ?)",
+            [
+                ("version", SCHEMA_VERSION),
+                ("num_docs", self._num_docs),
+                ("total_length", self._total_length),
+            ],
+        )
+
+    def add(self, documents: list, ids: list[str]):
+        """Add the documents under the ids, replacing those already indexed."""
+        with self._lock:
+            self._delete(ids)
+            for doc, id_ in zip(documents, ids):
+                terms = Counter(tokenize(doc.page_content))
+                self._conn.execute(
+                    "INSERT INTO chunks VALUES (?, ?, ?, ?)",
+                    (
+                        id_,
+                        doc.page_content,
+                        json.dumps(doc.metadata),
+                        sum(terms.values()),
+                    ),
+                )
+                self._conn.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    [(term, id_, tf) for term, tf in terms.items()],
+                )
+                self._num_docs += 1
+                self._total_length += sum(terms.values())
+            self._write_stats()
+            self._conn.commit()
+
+    def _delete(self, ids: list[str]):
+        for i in range(0, len(ids), 500):
+            batch = ids[i : i + 500]
+            placeholders = ", ".join("?" * len(batch))
+            count, length = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks "
+                f"WHERE id IN ({placeholders})",
+                batch,
+            ).fetchone()
+            self._num_docs -= count
+            self._total_length -= length
+            self._conn.execute(
+                f"DELETE FROM chunks WHERE id IN ({placeholders})", batch
+            )
+            self._conn.execute(
+                f"DELETE FROM postings WHERE id IN ({placeholders})", batch
+            )
+
+    def delete(self, ids: list[str]):
+        """Delete the documents of the ids."""
+        with self._lock:
+            self._delete(list(ids))
+            self._write_stats()
+            self._conn.commit()
+
+    def clear(self):
+        """Delete all the documents."""
+        with self._lock:
+            self._conn.execute("DELETE FROM chunks")
+            self._conn.execute("DELETE FROM postings")
+            self._num_docs = self._total_length = 0
+            self._write_stats()
+            self._conn.commit()
+
+    def search(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """Get the k best documents for the query and their BM25 scores."""
+        terms = sorted(set(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            num_docs = self._num_docs
+            if not num_docs:
+                return []
+            avg_length = self._total_length / num_docs
+            rows = self._conn.execute(
+                "SELECT p.term, p.id, p.tf, c.length FROM postings p "
+                "JOIN chunks c ON c.id = p.id "
+                f"WHERE p.term IN ({', '.join('?' * len(terms))})",
+                terms,
+            ).fetchall()
+
+            doc_freqs = Counter(term for term, _, _, _ in rows)
+            scores = defaultdict(float)
+            for term, id_, tf, length in rows:
+                df = doc_freqs[term]
+                idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * length / (avg_length or 1))
+                scores[id_] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+            best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            results = []
+            for id_, score in best:
+                content, metadata = self._conn.execute(
+                    "SELECT content, metadata FROM chunks WHERE id = ?", (id_,)
+                ).fetchone()
+                doc = Document(page_content=content, metadata=json.loads(metadata))
+                results.append((doc, score))
+        return results
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._num_docs
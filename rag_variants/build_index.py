@@ -0,0 +1,53 @@
+"""Build or refresh the persisted vector index for the RAG variants.
+
+Only the chunks of new or changed pages are embedded. With `--add`, the URLs
+are added to the index instead of replacing its pages.
+"""
+
+import argparse
+from pathlib import Path
+
+from config import CHUNK_OVERLAP, CHUNK_SIZE, EMBEDDING_MODEL, INDEX_DIR, INDEX_URLS
+from vector_store import add_urls, build_vector_store
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("urls", nargs="*", default=INDEX_URLS, help="URLs to index")
+    parser.add_argument("--persist-dir", type=Path, default=INDEX_DIR)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=CHUNK_OVERLAP)
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL)
+    parser.add_argument(
+        "--force", action="store_true", help="Rebuild even if the index is up to date"
+    )
+    parser.add_argument(
+        "--add", action="store_true", help="Add the URLs, keeping the other pages"
+    )
+    args = parser.parse_args()
+
+    if args.add:
+        add_urls(
+            urls=args.urls,
+            persist_directory=args.persist_dir,
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            embedding_model=args.embedding_model,
+        )
+        return
+
+    build_vector_store(
+        urls=args.urls,
+        persist_directory=args.persist_dir,
+        chunk_size=args.chunk_size,
+        chunk_overlap=args.chunk_overlap,
+        embedding_model=args.embedding_model,
+        force=args.force,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Persistent caches for the RAG variants."""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from array import array
+from collections import Counter
+from pathlib import Path
+
+
+def normalize_text(text: str) -> str:
+    """Normalize case and whitespace so that trivially different texts match."""
+    return " ".join(text.lower().split())
+
+
+def content_hash(text: str) -> str:
+    """Get the sha256 hash of a text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    """Open a SQLite database shared between threads, in WAL mode.
+
+    With WAL, a commit appends to the log without an fsync of the database,
+    and readers do not wait on writers.
+    """
+    conn = sqlite3.connect(str(path), check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SqliteCache:
+    """A key-value store in SQLite, bounded in size (LRU) and in age (TTL).
+
+    Values are stored as JSON. The store is safe to share between threads.
+    So that hits stay off the disk, the access times of hits are written in
+    batches of `touch_batch_size`, and entries are evicted once every
+    `evict_every` inserts, so the store can exceed `max_entries` by up to
+    that many entries in between.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        table: str = "cache",
+        max_entries: int = 10_000,
+        ttl_seconds: float = 7 * 24 * 3600,
+        touch_batch_size: int = 64,
+        evict_every: int = 100,
+    ):
+        self.path = Path(path)
+        self.table = table
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.touch_batch_size = touch_batch_size
+        self.evict_every = evict_every
+        self._lock = threading.Lock()
+        # access times of the hits not written yet, and inserts since eviction
+        self._touched = {}
+        self._inserts = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = connect(self.path)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "key TEXT PRIMARY KEY, value TEXT, created_at REAL, last_access REAL)"
+        )
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str):
+        """Get the value for a key, or None if it is missing or expired."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.touch_batch_size:
+                self._write_touches()
+                self._conn.commit()
+        return json.loads(value)
+
+    def _write_touches(self):
+        self._conn.executemany(
+            f"UPDATE {self.table} SET last_access = ? WHERE key = ?",
+            [(last_access, key) for key, last_access in self._touched.items()],
+        )
+        self._touched.clear()
+
+    def _evict(self):
+        # the pending access times decide which entries are least recently used
+        self._write_touches()
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN ("
+                f"SELECT key FROM {self.table} ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def set(self, key: str, value):
+        """Set the value for a key, evicting the least recently used entries."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._touched.pop(key, None)
+            self._inserts += 1
+            if self._inserts >= self.evict_every:
+                self._inserts = 0
+                self._evict()
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(
+                f"SELECT COUNT(*) FROM {self.table}"
+            ).fetchone()
+        return count
+
+
+class GraderCache:
+    """Cache of grader verdicts with hit and miss counters per grader.
+
+    Verdicts are keyed on the grader, the normalized question, the hash of
+    the graded content and the version of the grader prompt.
+    """
+
+    def __init__(self, store: SqliteCache, enabled: bool = True):
+        self.store = store
+        self.enabled = enabled
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @staticmethod
+    def get_key(grader: str, question: str, content: str, prompt: str) -> str:
+        """Get the cache key for a verdict."""
+        prompt_version = content_hash(prompt)[:16]
+        return content_hash(
+            "\x1f".join(
+                [
+                    grader,
+                    prompt_version,
+                    normalize_text(question),
+                    content_hash(content),
+                ]
+            )
+        )
+
+    def get(self, grader: str, question: str, content: str, prompt: str) -> str | None:
+        """Get a cached verdict, or None if there is none."""
+        if not self.enabled:
+            return None
+        verdict = self.store.get(self.get_key(grader, question, content, prompt))
+        if verdict is None:
+            self.misses[grader] += 1
+        else:
+            self.hits[grader] += 1
+        return verdict
+
+    def set(self, grader: str, question: str, content: str, prompt: str, verdict: str):
+        """Cache a verdict."""
+        if self.enabled:
+            self.store.set(self.get_key(grader, question, content, prompt), verdict)
+
+    def stats(self) -> dict:
+        """Get the hits and misses for each grader."""
+        graders = sorted(set(self.hits) | set(self.misses))
+        return {
+            grader: {"hits": self.hits[grader], "misses": self.misses[grader]}
+            for grader in graders
+        }
+
+
+class EmbeddingStore:
+    """Embeddings in SQLite, keyed on the model and the hash of the text.
+
+    Vectors are stored as float32 blobs. The store is safe to share between
+    threads.
+    """
+
+    def __init__(self, path: Path, table: str = "embeddings"):
+        self.path = Path(path)
+        self.table = table
+        self._lock = threading.Lock()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = connect(self.path)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            "model TEXT, sha256 TEXT, vector BLOB, PRIMARY KEY (model, sha256))"
+        )
+        self._conn.commit()
+
+    def get_many(self, model: str, hashes: list[str]) -> dict[str, list[float]]:
+        """Get the vectors of the hashes that are in the store."""
+        vectors = {}
+        hashes = list(hashes)
+        with self._lock:
+            # stay under the limit of SQLite on the number of parameters
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i : i + 500]
+                rows = self._conn.execute(
+                    f"SELECT sha256, vector FROM {self.table} WHERE model = ? "
+                    f"AND sha256 IN ({', '.join('?' * len(batch))})",
+                    (model, *batch),
+                ).fetchall()
+                for sha256, blob in rows:
+                    vectors[sha256] = array("f", blob).tolist()
+        return vectors
+
+    def set_many(self, model: str, vectors: dict[str, list[float]]):
+        """Store the vectors of the hashes."""
+        with self._lock:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                [
+                    (model, sha256, array("f", vector).tobytes())
+                    for sha256, vector in vectors.items()
+                ],
+            )
+            self._conn.commit()
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._conn.execute(
+                f"SELECT COUNT(*) FROM {self.table}"
+            ).fetchone()
+        return count
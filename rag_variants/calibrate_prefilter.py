@@ -0,0 +1,153 @@
+"""Calibrate the thresholds of the document pre-filter on a labeled sample.
+
+The sample is a JSON lines file of retrieved documents, each with the
+question, the document text, its retrieval score and a 'yes'/'no' label:
+
+    {"question": "...", "document": "...", "score": 0.82, "label": "yes"}
+
+`--label-with-grader` builds such a sample by retrieving documents for the
+benchmark questions and labeling them with the LLM document grader. For
+each weight of the retrieval score, the thresholds are the widest at which
+auto-accepted and auto-rejected documents agree with the labels at the
+target accuracy; the weight deciding the most documents wins.
+"""
+
+import argparse
+import json
+from pathlib import Path
+
+from langchain.schema import Document
+from loguru import logger
+from prefilter import get_prefilter_score, get_retrieval_score
+
+QUESTIONS_PATH = Path(__file__).parent / "benchmark_questions.json"
+
+
+def label_with_grader(questions: list[str], path: Path):
+    """Write a sample of retrieved documents labeled by the LLM document grader."""
+    from agents import get_document_grader, get_index_retriever
+
+    retriever = get_index_retriever()
+    grader = get_document_grader()
+    with open(path, "w") as f:
+        for question in questions:
+            for doc in retriever.invoke(question):
+                # documents without a similarity score always go to the grader
+                score = get_retrieval_score(doc)
+                if score is None:
+                    continue
+                grade = grader.invoke(
+                    {"question": question, "document": doc.page_content}
+                )
+                row = {
+                    "question": question,
+                    "document": doc.page_content,
+                    "score": score,
+                    "label": grade.binary_score.lower(),
+                }
+                f.write(json.dumps(row) + "\n")
+    logger.info(f"Labeled sample written to {path}")
+
+
+def read_sample(path: Path) -> list[tuple[str, Document, bool]]:
+    """Read the questions, documents and labels of a sample."""
+    with open(path) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    return [
+        (
+            row["question"],
+            Document(page_content=row["document"], metadata={"score": row["score"]}),
+            row["label"].lower() == "yes",
+        )
+        for row in rows
+    ]
+
+
+def find_thresholds(scored: list[tuple[float, bool]], accuracy: float) -> dict:
+    """Find the lowest upper and the highest lower threshold at the accuracy.
+
+    Accepting the documents scoring at least the upper threshold must be
+    right for `accuracy` of them, and so must rejecting those scoring at
+    most the lower one.
+    """
+    scored = sorted(scored)
+    upper = lower = None
+    relevant = 0
+    for i in range(len(scored) - 1, -1, -1):
+        relevant += scored[i][1]
+        if relevant / (len(scored) - i) >= accuracy:
+            upper = scored[i][0]
+    not_relevant = 0
+    for i, (score, label) in enumerate(scored):
+        not_relevant += not label
+        if not_relevant / (i + 1) >= accuracy:
+            lower = score
+
+    # the bands must not overlap
+    if upper is not None and lower is not None and lower >= upper:
+        lower = None
+    accepted = sum(score >= upper for score, _ in scored) if upper is not None else 0
+    rejected = sum(score <= lower for score, _ in scored) if lower is not None else 0
+    return {
+        "upper": upper if upper is not None else float("inf"),
+        "lower": lower if lower is not None else float("-inf"),
+        "accepted": accepted,
+        "rejected": rejected,
+        "coverage": (accepted + rejected) / len(scored) if scored else 0.0,
+    }
+
+
+def calibrate(sample: list, accuracy: float, weights: list[float]) -> dict:
+    """Find the weight and thresholds deciding the most documents at the accuracy."""
+    results = []
+    for weight in weights:
+        scored = [
+            (get_prefilter_score(question, doc, score_weight=weight), label)
+            for question, doc, label in sample
+        ]
+        results.append({"weight": weight, **find_thresholds(scored, accuracy)})
+    return max(results, key=lambda result: result["coverage"])
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("sample", type=Path, help="Labeled sample, JSON lines")
+    parser.add_argument(
+        "--label-with-grader",
+        action="store_true",
+        help="Build the sample with the retriever and the LLM grader first",
+    )
+    parser.add_argument("--questions", type=Path, default=QUESTIONS_PATH)
+    parser.add_argument(
+        "--accuracy",
+        type=float,
+        default=0.95,
+        help="Share of the auto-graded documents that must agree with the labels",
+    )
+    parser.add_argument("--output", type=Path, help="Write the thresholds as JSON")
+    args = parser.parse_args()
+
+    if args.label_with_grader:
+        label_with_grader(json.loads(args.questions.read_text()), args.sample)
+
+    sample = read_sample(args.sample)
+    best = calibrate(sample, args.accuracy, [i / 10 for i in range(11)])
+
+    print(f"documents: {len(sample)}, relevant: {sum(s[2] for s in sample)}")
+    print(
+        f"auto-accepted: {best['accepted']}, auto-rejected: {best['rejected']}, "
+        f"LLM calls avoided: {best['coverage']:.0%}"
+    )
+    print(f"RAG_PREFILTER_SCORE_WEIGHT={best['weight']}")
+    print(f"RAG_PREFILTER_UPPER={best['upper']:.4f}")
+    print(f"RAG_PREFILTER_LOWER={best['lower']:.4f}")
+
+    if args.output:
+        args.output.write_text(json.dumps(best, indent=2))
+
+
+if __name__ == "__main__":
+    main()
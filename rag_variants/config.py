@@ -0,0 +1,126 @@
+"""Settings for the RAG variants, overridable through environment variables."""
+
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Corpus indexed into the vector store
+INDEX_URLS = [
+    "https://lilianweng.github.io/posts/2023-06-23-agent/",
+    "https://lilianweng.github.io/posts/2023-03-15-prompt-engineering/",
+    "https://lilianweng.github.io/posts/2023-10-25-adv-attack-llm/",
+]
+
+# Local state: persisted index and caches
+CACHE_DIR = Path(os.getenv("RAG_CACHE_DIR", Path(__file__).parent / ".cache"))
+
+# Vector store
+INDEX_DIR = Path(os.getenv("RAG_INDEX_DIR", Path(__file__).parent / ".index"))
+COLLECTION_NAME = "test-collection-mistral-embeddings"
+# "chroma", or "numpy" for an in-process memory-mapped matrix (numpy_index.py)
+VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "chroma")
+# dtype of the numpy backend matrix, "float32" or "float16"
+VECTOR_DTYPE = os.getenv("RAG_VECTOR_DTYPE", "float32")
+EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "mistral-embed")
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "250"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "0"))
+# Embedding cache: vectors keyed on the model and the hash of the text
+EMBEDDING_CACHE_ENABLED = os.getenv("RAG_EMBEDDING_CACHE", "1") == "1"
+EMBEDDING_CACHE_PATH = CACHE_DIR / "embeddings.sqlite"
+# number of texts missing from the cache embedded per API call
+EMBEDDING_BATCH_SIZE = int(os.getenv("RAG_EMBEDDING_BATCH_SIZE", "64"))
+# Fetching the pages of the index
+# raw HTML, ETag and Last-Modified of fetched pages, for conditional GETs
+PAGE_CACHE_DIR = CACHE_DIR / "pages"
+FETCH_MAX_CONNECTIONS = int(os.getenv("RAG_FETCH_MAX_CONNECTIONS", "16"))
+FETCH_MAX_PER_HOST = int(os.getenv("RAG_FETCH_MAX_PER_HOST", "4"))
+FETCH_TIMEOUT_S = float(os.getenv("RAG_FETCH_TIMEOUT_S", "30"))
+# pages are parsed and split in a pool of processes (0 for one per CPU) from
+# this many pages on
+PARSE_PROCESSES = int(os.getenv("RAG_PARSE_PROCESSES", "0"))
+PARSE_POOL_MIN_PAGES = int(os.getenv("RAG_PARSE_POOL_MIN_PAGES", "8"))
+
+# Retrieval
+# "vector", or "hybrid" to fuse the vector ranking with a BM25 keyword ranking
+RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "vector")
+# number of documents retrieved, and of candidates of each ranking in hybrid mode
+RETRIEVAL_K = int(os.getenv("RAG_RETRIEVAL_K", "4"))
+HYBRID_VECTOR_K = int(os.getenv("RAG_HYBRID_VECTOR_K", "8"))
+HYBRID_BM25_K = int(os.getenv("RAG_HYBRID_BM25_K", "8"))
+# constant of reciprocal rank fusion, damping the weight of the top ranks
+RRF_K = int(os.getenv("RAG_RRF_K", "60"))
+# tiktoken encoding used to measure chunks and context in tokens
+TOKEN_ENCODING = "gpt2"
+
+# Graders
+# "per_document" makes one grader call per document, "batch" one call for all,
+# "early_exit" one call per document by retrieval score until enough are relevant
+DOCUMENT_GRADER_MODE = os.getenv("RAG_DOCUMENT_GRADER_MODE", "per_document")
+# early exit: stop once this many documents (0 for no limit) or tokens of
+# relevant context (0 for no limit) are found, grading this many at a time
+EARLY_EXIT_RELEVANT_DOCS = int(os.getenv("RAG_EARLY_EXIT_RELEVANT_DOCS", "2"))
+EARLY_EXIT_RELEVANT_TOKENS = int(os.getenv("RAG_EARLY_EXIT_RELEVANT_TOKENS", "0"))
+EARLY_EXIT_WAVE_SIZE = int(os.getenv("RAG_EARLY_EXIT_WAVE_SIZE", "1"))
+# pre-filter: accept documents whose weighted retrieval score and keyword
+# overlap with the question is above the upper threshold, reject those below
+# the lower one, and only grade the others with the LLM
+PREFILTER_ENABLED = os.getenv("RAG_PREFILTER", "0") == "1"
+PREFILTER_UPPER = float(os.getenv("RAG_PREFILTER_UPPER", "0.85"))
+PREFILTER_LOWER = float(os.getenv("RAG_PREFILTER_LOWER", "0.35"))
+# weight of the retrieval score, the keyword overlap getting the rest
+PREFILTER_SCORE_WEIGHT = float(os.getenv("RAG_PREFILTER_SCORE_WEIGHT", "0.7"))
+GRADER_MAX_CONCURRENCY = int(os.getenv("RAG_GRADER_MAX_CONCURRENCY", "4"))
+# run the relevance grader alongside the hallucination grader instead of after it
+SPECULATIVE_ANSWER_GRADING = os.getenv("RAG_SPECULATIVE_ANSWER_GRADING", "0") == "1"
+
+# Grader cascade: a small model answers first with a self-reported confidence,
+# and the large model only when the answer is malformed or not confident enough
+GRADER_CASCADE = os.getenv("RAG_GRADER_CASCADE", "0") == "1"
+CASCADE_SMALL_MODEL = os.getenv("RAG_CASCADE_SMALL_MODEL", "mistral-small-latest")
+CASCADE_CONFIDENCE_THRESHOLD = float(
+    os.getenv("RAG_CASCADE_CONFIDENCE_THRESHOLD", "0.8")
+)
+
+# Grader verdict cache
+GRADER_CACHE_ENABLED = os.getenv("RAG_GRADER_CACHE", "1") == "1"
+GRADER_CACHE_PATH = CACHE_DIR / "graders.sqlite"
+GRADER_CACHE_MAX_ENTRIES = int(os.getenv("RAG_GRADER_CACHE_MAX_ENTRIES", "100000"))
+GRADER_CACHE_TTL_S = float(os.getenv("RAG_GRADER_CACHE_TTL_S", str(7 * 24 * 3600)))
+
+# Query router
+# "llm" always asks the LLM, "local" decides from the similarity of the question
+# to the index and only asks the LLM when the similarity is between thresholds
+ROUTER_MODE = os.getenv("RAG_ROUTER_MODE", "llm")
+ROUTER_VECTORSTORE_THRESHOLD = float(
+    os.getenv("RAG_ROUTER_VECTORSTORE_THRESHOLD", "0.80")
+)
+ROUTER_WEBSEARCH_THRESHOLD = float(os.getenv("RAG_ROUTER_WEBSEARCH_THRESHOLD", "0.60"))
+
+# Web search result cache
+WEB_SEARCH_CACHE_ENABLED = os.getenv("RAG_WEB_SEARCH_CACHE", "1") == "1"
+WEB_SEARCH_CACHE_PATH = CACHE_DIR / "web_search.sqlite"
+WEB_SEARCH_CACHE_MAX_ENTRIES = int(
+    os.getenv("RAG_WEB_SEARCH_CACHE_MAX_ENTRIES", "10000")
+)
+WEB_SEARCH_CACHE_TTL_S = float(os.getenv("RAG_WEB_SEARCH_CACHE_TTL_S", str(24 * 3600)))
+
+# Context passed to the generator
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "3000"))
+# estimated Jaccard similarity above which a chunk is a near-duplicate
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("RAG_NEAR_DUPLICATE_THRESHOLD", "0.8"))
+
+# Deadlines: seconds a run may take (0 for no deadline) and the cap on the
+# answers generated per run
+RUN_BUDGET_S = float(os.getenv("RAG_RUN_BUDGET_S", "0"))
+MAX_GENERATIONS = int(os.getenv("RAG_MAX_GENERATIONS", "3"))
+# time left below which the documents are not graded, answers are not checked,
+# and a rejected answer is returned instead of searching or generating again
+MIN_TIME_GRADING_S = float(os.getenv("RAG_MIN_TIME_GRADING_S", "8"))
+MIN_TIME_CHECK_S = float(os.getenv("RAG_MIN_TIME_CHECK_S", "4"))
+MIN_TIME_RETRY_S = float(os.getenv("RAG_MIN_TIME_RETRY_S", "10"))
+
+# Instrumentation: JSON lines file the runs of graph.py are appended to
+RUN_LOG_PATH = os.getenv("RAG_RUN_LOG_PATH")
@@ -0,0 +1,84 @@
+"""Pack the documents into a context for the generator within a token budget."""
+
+from dataclasses import dataclass, field
+
+from dedup import estimate_similarity, get_min_hasher
+from vector_store import count_tokens
+
+
+@dataclass
+class PackedContext:
+    """The documents packed into a context and a report of those dropped."""
+
+    documents: list = field(default_factory=list)
+    tokens: int = 0
+    dropped: list[dict] = field(default_factory=list)
+
+    @property
+    def text(self) -> str:
+        """Get the context as text."""
+        return format_documents(self.documents)
+
+    def report(self) -> dict:
+        """Get a summary of what was packed and what was dropped."""
+        return {
+            "packed": len(self.documents),
+            "tokens": self.tokens,
+            "dropped": self.dropped,
+        }
+
+
+def format_documents(documents: list) -> str:
+    """Join the content of the documents, without their metadata."""
+    return "\n\n".join(doc.page_content for doc in documents)
+
+
+def rank_documents(documents: list) -> list:
+    """Rank the documents by retrieval score, best first.
+
+    Documents without a score, such as web search results, keep their order
+    after the scored ones.
+    """
+    scored = [doc for doc in documents if doc.metadata.get("score") is not None]
+    unscored = [doc for doc in documents if doc.metadata.get("score") is None]
+    return (
+        sorted(scored, key=lambda doc: doc.metadata["score"], reverse=True) + unscored
+    )
+
+
+def pack_context(
+    documents: list, budget: int, duplicate_threshold: float = 0.8
+) -> PackedContext:
+    """Fill the context with the best ranked documents up to the token budget.
+
+    Documents that nearly duplicate a better ranked one are dropped, and so
+    are documents that would take the context over the budget.
+    """
+    hasher = get_min_hasher()
+    packed = PackedContext()
+    signatures = []
+
+    for doc in rank_documents(documents):
+        tokens = count_tokens(doc.page_content)
+        source = doc.metadata.get("source")
+
+        signature = hasher.signature(doc.page_content)
+        if any(
+            estimate_similarity(signature, s) >= duplicate_threshold for s in signatures
+        ):
+            packed.dropped.append(
+                {"source": source, "tokens": tokens, "reason": "near-duplicate"}
+            )
+            continue
+
+        if packed.tokens + tokens > budget:
+            packed.dropped.append(
+                {"source": source, "tokens": tokens, "reason": "over budget"}
+            )
+            continue
+
+        signatures.append(signature)
+        packed.documents.append(doc)
+        packed.tokens += tokens
+
+    return packed
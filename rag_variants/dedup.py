@@ -0,0 +1,71 @@
+"""Near-duplicate detection of documents with MinHash over word shingles."""
+
+import functools
+import hashlib
+import random
+
+from cache import normalize_text
+
+_PRIME = (1 << 61) - 1
+
+
+def get_shingles(text: str, size: int = 5) -> set[str]:
+    """Get the overlapping sequences of `size` words of a text."""
+    words = normalize_text(text).split()
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """Computes MinHash signatures whose agreement estimates Jaccard similarity."""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 5, seed: int = 1):
+        rng = random.Random(seed)
+        self.shingle_size = shingle_size
+        self.coefficients = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+            for _ in range(num_perm)
+        ]
+
+    def signature(self, text: str) -> tuple[int, ...]:
+        """Get the MinHash signature of a text."""
+        hashes = [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+            for s in get_shingles(text, self.shingle_size)
+        ]
+        return tuple(
+            min((a * h + b) % _PRIME for h in hashes) for a, b in self.coefficients
+        )
+
+
+def estimate_similarity(signature_1: tuple, signature_2: tuple) -> float:
+    """Estimate the Jaccard similarity of two texts from their signatures."""
+    matches = sum(h1 == h2 for h1, h2 in zip(signature_1, signature_2))
+    return matches / len(signature_1)
+
+
+@functools.lru_cache(maxsize=None)
+def get_min_hasher() -> MinHasher:
+    """Get the shared MinHasher."""
+    return MinHasher()
+
+
+def remove_near_duplicates(
+    documents: list, existing_documents: list | None = None, threshold: float = 0.8
+) -> list:
+    """Drop the documents that nearly duplicate an existing or an earlier document."""
+    hasher = get_min_hasher()
+    signatures = [
+        hasher.signature(doc.page_content) for doc in existing_documents or []
+    ]
+
+    kept = []
+    for doc in documents:
+        signature = hasher.signature(doc.page_content)
+        if any(estimate_similarity(signature, s) >= threshold for s in signatures):
+            continue
+        signatures.append(signature)
+        kept.append(doc)
+
+    return kept
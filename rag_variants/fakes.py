@@ -0,0 +1,366 @@
+"""Fake models and tools to run the RAG variants offline."""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+import agents
+from bm25_index import tokenize
+from langchain.schema import Document
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.pydantic_v1 import PrivateAttr
+from langchain_core.runnables import RunnableLambda
+from tools import get_web_search_tool, set_web_search_tool
+
+
+def parse_latency(spec) -> Callable[[random.Random], float]:
+    """Parse a latency distribution in seconds into a sampler.
+
+    The spec is a number for a fixed latency, `uniform:low,high`,
+    `normal:mean,std` (clipped at 0) or `lognormal:mu,sigma`.
+    """
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+
+    kind, _, params = str(spec).partition(":")
+    if not params:
+        return lambda rng: float(kind)
+    a, b = (float(p) for p in params.split(","))
+    if kind == "uniform":
+        return lambda rng: rng.uniform(a, b)
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(a, b))
+    if kind == "lognormal":
+        return lambda rng: rng.lognormvariate(a, b)
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def get_seeded_rng(*parts) -> random.Random:
+    """Get a random generator seeded by the parts, stable across processes."""
+    digest = hashlib.sha256("\x1f".join(str(p) for p in parts).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+# the id of the current run and how many times it drew for each key
+_current_run: ContextVar[tuple[str, Counter] | None] = ContextVar(
+    "fake_run", default=None
+)
+_draws_lock = threading.Lock()
+
+
+@contextmanager
+def fake_run(run_id: str):
+    """Scope the draws of the fakes to a run of the graph.
+
+    Within the scope, a draw is seeded by the run id and how many times the
+    run drew for the same prompt or query, so it does not depend on how
+    concurrent runs interleave.
+    """
+    token = _current_run.set((run_id, Counter()))
+    try:
+        yield
+    finally:
+        _current_run.reset(token)
+
+
+def count_draw(key: str, draws: Counter) -> tuple[str, int]:
+    """Count a draw for the key in the current run, or in `draws` outside runs.
+
+    Returns the id of the run, empty outside runs, and the count of the key.
+    """
+    run = _current_run.get()
+    run_id, draws = run if run else ("", draws)
+    with _draws_lock:
+        draws[key] += 1
+        return run_id, draws[key]
+
+
+class FakeChatModel(BaseChatModel):
+    """A chat model answering after a sampled latency.
+
+    Structured output is supported for the graders and the router. The
+    probability of a 'yes' verdict (of 'vectorstore' for the router) can be
+    set per schema name in `yes_rates`; schemas without a rate always get
+    `verdict` (`data_source` for the router). The batch document grader
+    gets one verdict per `<doc id=N>` document in the prompt. Every answer
+    reports `confidence`, for the grader cascade.
+
+    Latencies and verdicts are drawn from a generator seeded by `seed`, the
+    prompt and how many times the run saw the prompt (see `fake_run`), so
+    replays are deterministic even when questions run concurrently, while a
+    retried prompt can get a different verdict.
+    """
+
+    model: str = "fake"
+    temperature: float = 0.0
+    latency: float | str = 0.5
+    answer: str = "This is a fake answer."
+    verdict: str = "yes"
+    data_source: str = "vectorstore"
+    confidence: float = 1.0
+    yes_rates: dict = {}
+    seed: int = 0
+
+    _seen: Counter = PrivateAttr(default_factory=Counter)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _get_rng(self, text: str) -> random.Random:
+        """Get the generator for a prompt."""
+        key = hashlib.sha256(text.encode()).hexdigest()
+        run_id, seen = count_draw(key, self._seen)
+        return get_seeded_rng(self.seed, self.model, run_id, key, seen)
+
+    def _draw_verdict(self, schema_name: str, rng: random.Random) -> str:
+        """Draw a 'yes' or 'no' verdict for the schema."""
+        if schema_name not in self.yes_rates:
+            return self.verdict
+        return "yes" if rng.random() < self.yes_rates[schema_name] else "no"
+
+    def _answer(self, messages, structured_output) -> tuple[float, str]:
+        """Get the latency and the content of the answer to the messages."""
+        text = "\n".join(str(message.content) for message in messages)
+        rng = self._get_rng(text)
+        latency = parse_latency(self.latency)(rng)
+
+        if not structured_output:
+            return latency, self.answer
+
+        if "RouteQuery" in self.yes_rates:
+            vectorstore = self._draw_verdict("RouteQuery", rng) == "yes"
+            data_source = "vectorstore" if vectorstore else "websearch"
+        else:
+            data_source = self.data_source
+        # the batch document grader grades like the per-document one by default
+        batch_schema = (
+            "GradeDocumentsBatch"
+            if "GradeDocumentsBatch" in self.yes_rates
+            else "GradeDocuments"
+        )
+        indices = re.findall(r"<doc id=(\d+)>", text)
+        content = json.dumps(
+            {
+                "binary_score": self._draw_verdict(structured_output, rng),
+                "data_source": data_source,
+                "confidence": self.confidence,
+                "verdicts": [
+                    {
+                        "index": int(i),
+                        "binary_score": self._draw_verdict(batch_schema, rng),
+                    }
+                    for i in indices
+                ],
+            }
+        )
+        return latency, content
+
+    def _get_result(self, messages, content: str) -> ChatResult:
+        """Get the answer, reporting its words as tokens."""
+        prompt_tokens = sum(len(str(message.content).split()) for message in messages)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=content))],
+            llm_output={
+                "token_usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": len(content.split()),
+                }
+            },
+        )
+
+    def _generate(
+        self, messages, stop=None, run_manager=None, structured_output=None, **kwargs
+    ) -> ChatResult:
+        latency, content = self._answer(messages, structured_output)
+        time.sleep(latency)
+        return self._get_result(messages, content)
+
+    async def _agenerate(
+        self, messages, stop=None, run_manager=None, structured_output=None, **kwargs
+    ) -> ChatResult:
+        latency, content = self._answer(messages, structured_output)
+        await asyncio.sleep(latency)
+        return self._get_result(messages, content)
+
+    @staticmethod
+    def _get_chunks(content: str):
+        """Split the answer into chunks of one word, as a streaming API would."""
+        for i, word in enumerate(content.split(" ")):
+            text = word if i == 0 else " " + word
+            yield ChatGenerationChunk(message=AIMessageChunk(content=text))
+
+    def _stream(
+        self, messages, stop=None, run_manager=None, structured_output=None, **kwargs
+    ):
+        latency, content = self._answer(messages, structured_output)
+        time.sleep(latency)
+        for chunk in self._get_chunks(content):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self, messages, stop=None, run_manager=None, structured_output=None, **kwargs
+    ):
+        latency, content = self._answer(messages, structured_output)
+        await asyncio.sleep(latency)
+        for chunk in self._get_chunks(content):
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def with_structured_output(self, schema, **kwargs):
+        """Get a runnable answering with instances of the schema."""
+
+        def parse(message: AIMessage):
+            values = json.loads(message.content)
+            return schema.parse_obj(
+                {
+                    key: value
+                    for key, value in values.items()
+                    if key in schema.__fields__
+                }
+            )
+
+        return self.bind(structured_output=schema.__name__) | RunnableLambda(parse)
+
+
+class StubSearchTool:
+    """A web search tool answering after a sampled latency, counting its calls.
+
+    The latency takes the same specs as `FakeChatModel`.
+    """
+
+    def __init__(self, latency: float | str = 0.5, num_results: int = 3, seed: int = 0):
+        self.latency = parse_latency(latency)
+        self.num_results = num_results
+        self.seed = seed
+        self.calls = 0
+        self._seen = Counter()
+
+    def _get_latency(self, query: str) -> float:
+        self.calls += 1
+        run_id, seen = count_draw(query, self._seen)
+        return self.latency(get_seeded_rng(self.seed, run_id, query, seen))
+
+    def _get_results(self, query: str) -> list[dict]:
+        return [
+            {
+                "url": f"https://example.com/{i}",
+                "content": f"Result {i} of a web search for: {query}",
+            }
+            for i in range(self.num_results)
+        ]
+
+    def invoke(self, input: dict) -> list[dict]:
+        time.sleep(self._get_latency(input["query"]))
+        return self._get_results(input["query"])
+
+    async def ainvoke(self, input: dict) -> list[dict]:
+        await asyncio.sleep(self._get_latency(input["query"]))
+        return self._get_results(input["query"])
+
+
+class HashedWordEmbeddings(Embeddings):
+    """Embeddings counting the words of a text in hashed buckets, unit length.
+
+    They need no API, and as the counts are not negative, the cosine
+    similarity of two texts is in [0, 1] and grows with the words they
+    share, as the router and pre-filter thresholds assume of real ones.
+    """
+
+    def __init__(self, size: int = 256):
+        self.size = size
+
+    def _embed(self, text: str) -> list[float]:
+        vector = [0.0] * self.size
+        for term in tokenize(text):
+            digest = hashlib.sha256(term.encode()).digest()
+            vector[int.from_bytes(digest[:4], "big") % self.size] += 1.0
+        norm = sum(x * x for x in vector) ** 0.5 or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+def get_fake_embeddings(size: int = 256):
+    """Get embeddings that are deterministic in the text and need no API."""
+    return HashedWordEmbeddings(size=size)
+
+
+# topics of the indexed posts, in the words the benchmark questions use
+FAKE_TOPICS = [
+    "agent memory: short-term memory and long-term memory of agents",
+    "chain of thought prompting and tree of thoughts",
+    "few-shot prompting and instruction prompting",
+    "adversarial attacks on LLMs: jailbreak prompts, token manipulation and "
+    "gradient based attacks",
+    "task decomposition, ReAct prompting and self-reflection of LLM agents",
+    "agents using external tools and maximum inner product search",
+]
+
+
+def create_fake_vector_store(num_docs: int = 100):
+    """Create an in-memory vector store of synthetic documents on the topics.
+
+    The collection is in cosine space, so relevance scores are cosine
+    similarities as with the persisted index.
+    """
+    docs = [
+        Document(
+            page_content=f"{FAKE_TOPICS[i % len(FAKE_TOPICS)]}.",
+            metadata={"source": f"fake://{i}"},
+        )
+        for i in range(num_docs)
+    ]
+    return Chroma.from_documents(
+        documents=docs,
+        collection_name=f"fake-{uuid.uuid4().hex}",
+        embedding=get_fake_embeddings(),
+        collection_metadata={"hnsw:space": "cosine"},
+    )
+
+
+def use_fakes(
+    latency: float | str = 0.5,
+    search_latency: float | str | None = None,
+    yes_rates: dict | None = None,
+    seed: int = 0,
+):
+    """Run the graph against a fake LLM, vector store and web search.
+
+    The search latency defaults to the LLM latency; `yes_rates` and `seed`
+    are passed to `FakeChatModel`.
+    """
+    agents.set_llm_factory(
+        lambda **kwargs: FakeChatModel(
+            latency=latency, yes_rates=yes_rates or {}, seed=seed, **kwargs
+        )
+    )
+    agents.set_vector_store(create_fake_vector_store())
+    set_web_search_tool(
+        StubSearchTool(
+            latency=latency if search_latency is None else search_latency, seed=seed
+        )
+    )
+    # every question has to reach the graders and the web search
+    agents.get_grader_cache().enabled = False
+    get_web_search_tool().enabled = False
@@ -0,0 +1,182 @@
+"""Fetch web pages concurrently with conditional GETs, and parse them to text.
+
+The raw HTML of each page is kept on disk with its ETag and Last-Modified
+headers, so that a refresh asks the server whether the page changed and
+skips unchanged pages without downloading or parsing them again. The caller
+saves fetched pages to the cache only once they are indexed, so that a
+failed refresh does not leave the cache ahead of the index.
+"""
+
+import asyncio
+import json
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urlparse
+
+import httpx
+from bs4 import BeautifulSoup
+from cache import content_hash
+from config import (
+    FETCH_MAX_CONNECTIONS,
+    FETCH_MAX_PER_HOST,
+    FETCH_TIMEOUT_S,
+    PAGE_CACHE_DIR,
+    PARSE_POOL_MIN_PAGES,
+    PARSE_PROCESSES,
+)
+from langchain.schema import Document
+from loguru import logger
+
+USER_AGENT = "Mozilla/5.0 (compatible; rag-variants-indexer)"
+
+
+@dataclass
+class FetchedPage:
+    """The HTML of a page, whether it changed, and its ETag and Last-Modified."""
+
+    url: str
+    html: str
+    changed: bool
+    validators: dict
+
+
+class PageCache:
+    """The raw HTML and the validators (ETag, Last-Modified) of fetched pages."""
+
+    def __init__(self, directory: Path = PAGE_CACHE_DIR):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _paths(self, url: str) -> tuple[Path, Path]:
+        name = content_hash(url)[:32]
+        return self.directory / f"{name}.html", self.directory / f"{name}.json"
+
+    def get(self, url: str) -> tuple[str, dict] | None:
+        """Get the cached HTML and headers of a page, or None if it is missing."""
+        html_path, meta_path = self._paths(url)
+        if not html_path.exists() or not meta_path.exists():
+            return None
+        return html_path.read_text(encoding="utf-8"), json.loads(meta_path.read_text())
+
+    def set(self, url: str, html: str, validators: dict):
+        """Cache the HTML and validators of a page."""
+        html_path, meta_path = self._paths(url)
+        html_path.write_text(html, encoding="utf-8")
+        meta = {"url": url, **validators, "fetched_at": time.time()}
+        meta_path.write_text(json.dumps(meta))
+
+    def save(self, pages: list[FetchedPage]):
+        """Cache the pages that changed since the last fetch."""
+        for page in pages:
+            if page.changed:
+                self.set(page.url, page.html, page.validators)
+
+
+def get_validators(headers: httpx.Headers) -> dict:
+    """Get the validators of a response, to ask for the page again if it changed."""
+    return {"etag": headers.get("etag"), "last_modified": headers.get("last-modified")}
+
+
+def get_conditional_headers(meta: dict) -> dict:
+    """Get the headers asking the server for the page only if it changed."""
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+async def fetch_pages(
+    urls: list[str],
+    page_cache: PageCache,
+    max_per_host: int = FETCH_MAX_PER_HOST,
+    max_connections: int = FETCH_MAX_CONNECTIONS,
+    timeout: float = FETCH_TIMEOUT_S,
+) -> dict[str, FetchedPage]:
+    """Fetch the pages over one pooled client, at most `max_per_host` per host.
+
+    Pages in the cache are fetched with a conditional GET, and a 304 answer
+    returns the cached HTML as unchanged. The pages that fail to fetch are
+    logged and left out. The fetched pages are not cached; call
+    `PageCache.save` once they are indexed.
+    """
+    host_limits = defaultdict(lambda: asyncio.Semaphore(max_per_host))
+    limits = httpx.Limits(max_connections=max_connections)
+
+    async with httpx.AsyncClient(
+        limits=limits,
+        timeout=timeout,
+        follow_redirects=True,
+        headers={"User-Agent": USER_AGENT},
+    ) as client:
+
+        async def fetch(url: str) -> FetchedPage:
+            cached = page_cache.get(url)
+            headers = get_conditional_headers(cached[1]) if cached else {}
+            async with host_limits[urlparse(url).netloc]:
+                response = await client.get(url, headers=headers)
+            if response.status_code == 304 and cached:
+                return FetchedPage(
+                    url=url, html=cached[0], changed=False, validators=cached[1]
+                )
+            response.raise_for_status()
+            return FetchedPage(
+                url=url,
+                html=response.text,
+                changed=True,
+                validators=get_validators(response.headers),
+            )
+
+        results = await asyncio.gather(
+            *(fetch(url) for url in urls), return_exceptions=True
+        )
+
+    pages = {}
+    for url, result in zip(urls, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to fetch {url}: {result!r}")
+        else:
+            pages[url] = result
+    unchanged = sum(not page.changed for page in pages.values())
+    logger.info(
+        f"Fetched {len(pages)} pages, {unchanged} unchanged, "
+        f"{len(urls) - len(pages)} failed"
+    )
+    return pages
+
+
+def parse_html(url: str, html: str) -> tuple[str, dict]:
+    """Get the text and metadata of a page as `WebBaseLoader` does."""
+    soup = BeautifulSoup(html, "html.parser")
+    metadata = {"source": url}
+    if title := soup.find("title"):
+        metadata["title"] = title.get_text()
+    if description := soup.find("meta", attrs={"name": "description"}):
+        metadata["description"] = description.get("content", "No description found.")
+    if html_tag := soup.find("html"):
+        metadata["language"] = html_tag.get("lang", "No language found.")
+    return soup.get_text(), metadata
+
+
+def parse_pages(
+    pages: list[FetchedPage],
+    processes: int | None = PARSE_PROCESSES,
+    min_pool_pages: int = PARSE_POOL_MIN_PAGES,
+) -> dict[str, list]:
+    """Parse the pages into documents, in a process pool for many pages."""
+    urls = [page.url for page in pages]
+    htmls = [page.html for page in pages]
+    if len(pages) >= min_pool_pages:
+        with ProcessPoolExecutor(max_workers=processes or None) as pool:
+            parsed = list(pool.map(parse_html, urls, htmls))
+    else:
+        parsed = [parse_html(url, html) for url, html in zip(urls, htmls)]
+
+    return {
+        url: [Document(page_content=text, metadata=metadata)]
+        for url, (text, metadata) in zip(urls, parsed)
+    }
@@ -1,6 +1,17 @@
 """A set of prompts for different graders in the graph."""
 
 
+def get_rag_prompt() -> str:
+    """
+    Returns the prompt for answering a question from retrieved context,
+    vendored from the `rlm/rag-prompt` prompt on the LangChain hub.
+    """
+    return """You are an assistant for question-answering tasks. Use the following pieces of retrieved context to answer the question. If you don't know the answer, just say that you don't know. Use three sentences maximum and keep the answer concise.
+Question: {question} 
+Context: {context} 
+Answer:"""
+
+
 def get_hallucination_grader_prompt():
     return """You are a grader assessing whether an LLM generation is grounded in / supported by a set of retrieved facts. \n 
      Give a binary score 'yes' or 'no'. 'Yes' means that the answer is grounded in / supported by the set of facts."""
@@ -12,6 +23,17 @@ def get_document_grader_prompt():
     Give a binary score 'yes' or 'no' score to indicate whether the document is relevant to the question."""
 
 
+def get_batch_document_grader_prompt() -> str:
+    """
+    Returns a string prompt for a grader assessing the relevance
+    of each document in a numbered list to a user question.
+    """
+    return """You are a grader assessing relevance of retrieved documents to a user question. \n
+    Each document is enclosed in <doc id=N> and </doc> tags, where N is its index. Grade each document on its own. \n
+    If a document contains keyword(s) or semantic meaning related to the question, grade it as relevant. \n
+    For every document give its index and a binary score 'yes' or 'no' to indicate whether it is relevant to the question."""
+
+
 def get_relevance_grader_prompt() -> str:
     """
     Returns a string prompt for a grader assessing whether
@@ -2,9 +2,10 @@ from enum import Enum
 
 """definition of different graders"""
 
-from typing import Literal
+import functools
+from typing import List, Literal
 
-from langchain_core.pydantic_v1 import BaseModel, Field
+from langchain_core.pydantic_v1 import BaseModel, Field, create_model
 
 
 class GradeDocuments(BaseModel):
@@ -17,6 +18,25 @@ class GradeDocuments(BaseModel):
     )
 
 
+class DocumentVerdict(BaseModel):
+    """Binary score for the relevance of one document in a list."""
+
+    index: int = Field(description="Index of the document, the id of its <doc> tag")
+    binary_score: str = Field(
+        description="Document is relevant to the question, 'yes' or 'no'"
+    )
+
+
+class GradeDocumentsBatch(BaseModel):
+    """
+    Binary scores for the relevance of a list of documents.
+    """
+
+    verdicts: List[DocumentVerdict] = Field(
+        description="One verdict for each document, keyed by the index of the document"
+    )
+
+
 class GradeHallucinations(BaseModel):
     """Binary score for hallucinations in the answer."""
 
@@ -47,3 +67,21 @@ class RouteQuery(BaseModel):
         ...,
         description="Given a user question route the query to either web search or vector store.",
     )
+
+
+@functools.lru_cache(maxsize=None)
+def with_confidence(schema: type[BaseModel]) -> type[BaseModel]:
+    """Get the schema of a grader with a self-reported confidence in its answer.
+
+    The schema keeps its name, so that the tool the model calls is the same.
+    """
+    model = create_model(
+        schema.__name__,
+        __base__=schema,
+        confidence=(
+            float,
+            Field(description="Confidence in the answer, from 0 (a guess) to 1 (sure)"),
+        ),
+    )
+    model.__doc__ = schema.__doc__
+    return model
@@ -3,32 +3,64 @@
 from pprint import pprint
 
 from agents import (
-    check_for_hallucinations_and_relevance,
+    agenerate,
+    agrade_documents,
+    agrade_generation,
+    aretrieve,
+    aroute_query,
+    aweb_search,
+    create_inputs,
+    deadline_stats,
+    decide_after_grading,
     decide_to_generate,
     generate,
+    get_cascade_stats,
+    get_grader_cache,
     grade_documents,
+    grade_generation,
+    grading_stats,
     retrieve,
+    return_best_generation,
     route_query,
+    routing_stats,
     web_search,
 )
+from config import RUN_LOG_PATH
 from dotenv import load_dotenv
 from graph_state import GraphState
+from instrumentation import RunRecorder
 from langgraph.graph import END, StateGraph
+from streaming import stream_with_tokens
+from tools import get_web_search_tool
+from vector_store import get_embeddings
 
 
-def create_graph_rag_variant():
-    """Create the graph of the RAG variants."""
+def create_graph_rag_variant(use_async: bool = False):
+    """Create the graph of the RAG variants.
+
+    With `use_async` the nodes and edges are coroutines, and the compiled
+    graph must be run with `ainvoke` or `astream`.
+    """
     workflow = StateGraph(GraphState)
 
     # Define nodes
-    workflow.add_node("websearch", web_search)
-    workflow.add_node("retrieve", retrieve)
-    workflow.add_node("grade_documents", grade_documents)
-    workflow.add_node("generate", generate)
+    if use_async:
+        workflow.add_node("websearch", aweb_search)
+        workflow.add_node("retrieve", aretrieve)
+        workflow.add_node("grade_documents", agrade_documents)
+        workflow.add_node("generate", agenerate)
+        workflow.add_node("grade_generation", agrade_generation)
+    else:
+        workflow.add_node("websearch", web_search)
+        workflow.add_node("retrieve", retrieve)
+        workflow.add_node("grade_documents", grade_documents)
+        workflow.add_node("generate", generate)
+        workflow.add_node("grade_generation", grade_generation)
+    workflow.add_node("return_best_generation", return_best_generation)
 
     # Build the graph
     workflow.set_conditional_entry_point(
-        route_query,
+        aroute_query if use_async else route_query,
         {
             "vectorstore": "retrieve",
             "websearch": "websearch",
@@ -43,11 +75,18 @@ def create_graph_rag_variant():
         {"websearch": "websearch", "generate": "generate"},
     )
     # workflow.add_edge("websearch", "generate")
+    workflow.add_edge("generate", "grade_generation")
     workflow.add_conditional_edges(
-        "generate",
-        check_for_hallucinations_and_relevance,
-        {"useful": END, "not useful": "websearch", "not supported": "generate"},
+        "grade_generation",
+        decide_after_grading,
+        {
+            "useful": END,
+            "not useful": "websearch",
+            "not supported": "generate",
+            "stop": "return_best_generation",
+        },
     )
+    workflow.add_edge("return_best_generation", END)
     # workflow.add_edge("generate", END)
 
     # Compile the graph
@@ -72,12 +111,47 @@ def main():
     # inputs = {
     #     "question": "How does the concept of adversarial attack work in the LLM space?"
     # }
-    inputs = {"question": "Who was the father of Kublai Khan?"}
+    inputs = create_inputs("Who was the father of Kublai Khan?")
 
-    for output in app.stream(inputs):
-        for key, value in output.items():
+    node_timings = []
+    time_to_first_token = None
+    last_finished = 0.0
+    state = {}
+    recorder = RunRecorder()
+    config = {"callbacks": [recorder]}
+    for event in stream_with_tokens(app, inputs, config):
+        if event["event"] == "token":
+            if time_to_first_token is None:
+                time_to_first_token = event["elapsed"]
+            print(event["text"], end="", flush=True)
+        elif event["event"] == "retry":
+            print(f"\n[answer rejected ({event['reason']}), retrying]")
+        elif event["event"] == "node":
+            key = event["node"]
+            state.update(event["value"])
+            node_timings.append((key, event["elapsed"] - last_finished))
+            last_finished = event["elapsed"]
             pprint(f"Finished running: {key}: ")
-    pprint(value["generation"])
+    pprint(state["generation"])
+    if state.get("degraded"):
+        pprint(f"Degraded: best answer after stopping, graded {state['best_grade']}")
+
+    print(f"{'node':<20}{'time (s)':>10}")
+    for key, elapsed in node_timings:
+        print(f"{key:<20}{elapsed:>10.2f}")
+    if time_to_first_token is not None:
+        print(f"{'time to first token':<20}{time_to_first_token:>10.2f}")
+    print(f"{'total':<20}{last_finished:>10.2f}")
+    print(recorder.summary_table())
+    if RUN_LOG_PATH:
+        recorder.export_jsonl(RUN_LOG_PATH)
+    pprint(f"Grader cache: {get_grader_cache().stats()}")
+    pprint(f"Router paths: {dict(routing_stats)}")
+    pprint(f"Document grading: {dict(grading_stats)}")
+    pprint(f"Grader cascades: {get_cascade_stats()}")
+    pprint(f"Degraded paths: {dict(deadline_stats)}")
+    pprint(f"Web search cache: {get_web_search_tool().stats()}")
+    pprint(f"Embedding cache: {get_embeddings().stats()}")
 
 
 if __name__ == "__main__":
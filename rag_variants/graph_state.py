@@ -12,9 +12,27 @@ class GraphState(TypedDict):
         generation: The answer generated by LLM
         web_search: Whether to invoke web search
         documents: The list of documents
+        searched_queries: The normalized queries already searched on the web
+        context_report: What was packed into the context of the generator
+        deadline: The time.time() by which the run should end, if any
+        generations: The number of answers generated so far
+        generation_grade: The grade of the last answer, "useful", "not useful",
+            "not supported" or "unchecked"
+        best_generation: The best answer so far, preferring grounded ones
+        best_grade: The grade of the best answer so far
+        degraded: Whether the run stopped, out of time or generations, with
+            the best answer rather than a useful one
     """
 
     question: str
     generation: str
     web_search: str
     documents: List[str]
+    searched_queries: List[str]
+    context_report: dict
+    deadline: float
+    generations: int
+    generation_grade: str
+    best_generation: str
+    best_grade: str
+    degraded: bool
@@ -0,0 +1,281 @@
+"""Record the latency, tokens and retries of the nodes and LLM calls of graph runs.
+
+The recorder is a LangChain callback handler, so it works for any compiled
+LangGraph graph without touching its nodes:
+
+    recorder = RunRecorder()
+    app.invoke(inputs, config={"callbacks": [recorder]})
+    print(recorder.summary_table())
+"""
+
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+@dataclass
+class LLMCallRecord:
+    """One call to an LLM."""
+
+    node: str | None
+    model: str | None
+    latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    error: str | None = None
+
+
+@dataclass
+class NodeRecord:
+    """One execution of a node of the graph."""
+
+    node: str
+    started: float
+    wall_time: float = 0.0
+    llm_calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    error: str | None = None
+
+
+@dataclass
+class RunRecord:
+    """One run of the graph."""
+
+    run_id: str
+    started: float
+    wall_time: float = 0.0
+    nodes: list[NodeRecord] = field(default_factory=list)
+    llm_calls: list[LLMCallRecord] = field(default_factory=list)
+    error: str | None = None
+
+    def totals(self) -> dict:
+        """Get the totals of the run."""
+        node_counts = defaultdict(int)
+        for node in self.nodes:
+            node_counts[node.node] += 1
+        return {
+            "wall_time": self.wall_time,
+            "llm_calls": len(self.llm_calls),
+            "prompt_tokens": sum(c.prompt_tokens for c in self.llm_calls),
+            "completion_tokens": sum(c.completion_tokens for c in self.llm_calls),
+            "retries": sum(c.retries for c in self.llm_calls),
+            "node_executions": dict(node_counts),
+        }
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Get the q-th percentile (0-100) of the values by the nearest-rank method."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(q / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def get_token_usage(response) -> tuple[int, int]:
+    """Get the prompt and completion tokens of an LLM response, 0 if not reported."""
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            usage_metadata = getattr(message, "usage_metadata", None) or {}
+            prompt_tokens += usage_metadata.get("input_tokens", 0)
+            completion_tokens += usage_metadata.get("output_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
+class RunRecorder(BaseCallbackHandler):
+    """Callback handler recording every run of a graph it is passed to.
+
+    The nodes are the direct children of the run of the graph. Nodes whose
+    name starts with `__`, such as the conditional entry point, are ignored
+    unless `node_names` lists them; with `node_names`, only those are kept.
+    """
+
+    run_inline = True
+
+    def __init__(self, node_names: list[str] | None = None):
+        self.node_names = set(node_names) if node_names else None
+        self.runs: list[RunRecord] = []
+        self._lock = threading.Lock()
+        self._open_runs: dict[UUID, RunRecord] = {}
+        self._root_of: dict[UUID, UUID] = {}
+        self._node_runs: dict[UUID, NodeRecord] = {}
+        self._node_of: dict[UUID, NodeRecord] = {}
+        self._llm_calls: dict[UUID, tuple[float, LLMCallRecord]] = {}
+
+    def _is_node(self, name: str | None) -> bool:
+        if name is None:
+            return False
+        if self.node_names is not None:
+            return name in self.node_names
+        return not name.startswith("__")
+
+    def _track(self, run_id: UUID, parent_run_id: UUID | None):
+        """Track the root run and the node a run belongs to."""
+        root = self._root_of.get(parent_run_id, parent_run_id)
+        self._root_of[run_id] = root if root is not None else run_id
+        if parent_run_id in self._node_of:
+            self._node_of[run_id] = self._node_of[parent_run_id]
+
+    def on_chain_start(
+        self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs
+    ):
+        name = kwargs.get("name") or (serialized or {}).get("name")
+        now = time.perf_counter()
+        with self._lock:
+            self._track(run_id, parent_run_id)
+            if parent_run_id is None:
+                self._open_runs[run_id] = RunRecord(run_id=str(run_id), started=now)
+            elif parent_run_id in self._open_runs and self._is_node(name):
+                node = NodeRecord(node=name, started=now)
+                self._open_runs[parent_run_id].nodes.append(node)
+                self._node_runs[run_id] = node
+                self._node_of[run_id] = node
+
+    def _end_chain(self, run_id: UUID, error: BaseException | None = None):
+        now = time.perf_counter()
+        with self._lock:
+            run = self._open_runs.pop(run_id, None)
+            if run is not None:
+                run.wall_time = now - run.started
+                run.error = repr(error) if error else None
+                self.runs.append(run)
+                for child, root in list(self._root_of.items()):
+                    if root == run_id:
+                        del self._root_of[child]
+                        self._node_of.pop(child, None)
+                return
+            node = self._node_runs.pop(run_id, None)
+            if node is not None:
+                node.wall_time = now - node.started
+                node.error = repr(error) if error else None
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end_chain(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end_chain(run_id, error)
+
+    def _start_llm(self, run_id: UUID, parent_run_id: UUID | None, **kwargs):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model") or params.get("model_name")
+        with self._lock:
+            self._track(run_id, parent_run_id)
+            node = self._node_of.get(run_id)
+            call = LLMCallRecord(node=node.node if node else None, model=model)
+            self._llm_calls[run_id] = (time.perf_counter(), call)
+
+    def on_llm_start(
+        self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start_llm(run_id, parent_run_id, **kwargs)
+
+    def on_chat_model_start(
+        self, serialized, messages, *, run_id, parent_run_id=None, **kwargs
+    ):
+        self._start_llm(run_id, parent_run_id, **kwargs)
+
+    def on_retry(self, retry_state, *, run_id, **kwargs):
+        with self._lock:
+            if run_id in self._llm_calls:
+                self._llm_calls[run_id][1].retries += 1
+
+    def _end_llm(self, run_id: UUID, response=None, error=None):
+        now = time.perf_counter()
+        with self._lock:
+            started, call = self._llm_calls.pop(run_id, (None, None))
+            if call is None:
+                return
+            call.latency = now - started
+            if response is not None:
+                call.prompt_tokens, call.completion_tokens = get_token_usage(response)
+            call.error = repr(error) if error else None
+
+            run = self._open_runs.get(self._root_of.get(run_id))
+            if run is not None:
+                run.llm_calls.append(call)
+            node = self._node_of.get(run_id)
+            if node is not None:
+                node.llm_calls += 1
+                node.prompt_tokens += call.prompt_tokens
+                node.completion_tokens += call.completion_tokens
+                node.retries += call.retries
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end_llm(run_id, response=response)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end_llm(run_id, error=error)
+
+    def export_jsonl(self, path: Path):
+        """Append one JSON line per finished run to a file."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, open(path, "a") as f:
+            for run in self.runs:
+                f.write(json.dumps({**asdict(run), "totals": run.totals()}) + "\n")
+
+    def summarize(self) -> dict:
+        """Get the p50 and p95 of the wall time and LLM latency of each node.
+
+        The row `(run)` is for whole runs, and `(outside nodes)` for the LLM
+        calls made outside of any node, such as in the conditional entry point.
+        """
+        wall_times = defaultdict(list)
+        llm_latencies = defaultdict(list)
+        tokens = defaultdict(int)
+        with self._lock:
+            for run in self.runs:
+                wall_times["(run)"].append(run.wall_time)
+                for node in run.nodes:
+                    wall_times[node.node].append(node.wall_time)
+                for call in run.llm_calls:
+                    name = call.node or "(outside nodes)"
+                    llm_latencies[name].append(call.latency)
+                    tokens[name] += call.prompt_tokens + call.completion_tokens
+                    tokens["(run)"] += call.prompt_tokens + call.completion_tokens
+            llm_latencies["(run)"] = [
+                call.latency for run in self.runs for call in run.llm_calls
+            ]
+
+        return {
+            name: {
+                "count": len(wall_times[name]),
+                "p50": percentile(wall_times[name], 50),
+                "p95": percentile(wall_times[name], 95),
+                "llm_calls": len(llm_latencies[name]),
+                "llm_p50": percentile(llm_latencies[name], 50),
+                "llm_p95": percentile(llm_latencies[name], 95),
+                "tokens": tokens[name],
+            }
+            for name in list(wall_times) + sorted(set(llm_latencies) - set(wall_times))
+        }
+
+    def summary_table(self) -> str:
+        """Get the summary of the nodes as a text table."""
+        lines = [
+            f"{'node':<20}{'count':>7}{'p50 (s)':>10}{'p95 (s)':>10}"
+            f"{'llm calls':>11}{'llm p50 (s)':>13}{'llm p95 (s)':>13}{'tokens':>9}"
+        ]
+        for name, row in self.summarize().items():
+            lines.append(
+                f"{name:<20}{row['count']:>7}{row['p50']:>10.3f}{row['p95']:>10.3f}"
+                f"{row['llm_calls']:>11}{row['llm_p50']:>13.3f}{row['llm_p95']:>13.3f}"
+                f"{row['tokens']:>9}"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,115 @@
+"""Load test the RAG variants service."""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+
+def start_service(port: int, latency: float) -> subprocess.Popen:
+    """Start the service with a fake LLM backend and wait until it is healthy."""
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            str(Path(__file__).parent / "service.py"),
+            "--port",
+            str(port),
+            "--fake-llm",
+            "--fake-latency",
+            str(latency),
+        ]
+    )
+    for _ in range(300):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/health").raise_for_status()
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("The service did not become healthy")
+
+
+async def ask(client: httpx.AsyncClient, question: str) -> tuple[float, bool]:
+    """Ask a question and return the latency and whether it succeeded."""
+    start = time.perf_counter()
+    ok = True
+    async with client.stream("POST", "/ask/stream", json={"question": question}) as r:
+        async for line in r.aiter_lines():
+            if line and json.loads(line)["event"] == "error":
+                ok = False
+    return time.perf_counter() - start, ok and r.status_code == 200
+
+
+async def run_load(
+    url: str, num_requests: int, concurrency: int, num_distinct: int
+) -> dict:
+    """Send the requests, drawing the questions from a pool of distinct questions."""
+    questions = [f"Question {i} about agent memory?" for i in range(num_distinct)]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(base_url=url, timeout=None) as client:
+
+        async def run_one() -> tuple[float, bool]:
+            async with semaphore:
+                return await ask(client, random.choice(questions))
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(run_one() for _ in range(num_requests)))
+        elapsed = time.perf_counter() - start
+        service_stats = (await client.get("/stats")).json()
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        "requests": num_requests,
+        "errors": sum(not ok for _, ok in results),
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(num_requests / elapsed, 2),
+        "p50_s": round(statistics.median(latencies), 3),
+        "p95_s": round(latencies[int(0.95 * (len(latencies) - 1))], 3),
+        "service": service_stats["service"],
+    }
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", help="URL of a running service, else one is started")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("-n", "--num-requests", type=int, default=200)
+    parser.add_argument("-c", "--concurrency", type=int, default=50)
+    parser.add_argument(
+        "--num-distinct",
+        type=int,
+        default=20,
+        help="Number of distinct questions, fewer means more coalescing",
+    )
+    parser.add_argument("--fake-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    process = None
+    url = args.url
+    if url is None:
+        process = start_service(args.port, args.fake_latency)
+        url = f"http://127.0.0.1:{args.port}"
+
+    try:
+        report = asyncio.run(
+            run_load(url, args.num_requests, args.concurrency, args.num_distinct)
+        )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+"""An in-process vector store over a memory-mapped NumPy matrix.
+
+The normalized embeddings are kept in `vectors.bin`, a raw float32 (or
+float16) matrix that is memory-mapped rather than loaded, next to a sidecar
+`metadata.jsonl` with the id, text and metadata of each row and an
+`index.json` with the shape of the matrix. Search is a matrix product and an
+`argpartition`, so it needs no server and starts as fast as the files open.
+The product is taken over blocks of rows, each upcast to float32 on its own,
+so that a float16 matrix is never copied whole.
+"""
+
+import json
+import os
+import threading
+import uuid
+from pathlib import Path
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+VECTORS_FILE = "vectors.bin"
+METADATA_FILE = "metadata.jsonl"
+INDEX_FILE = "index.json"
+# rows upcast and multiplied at a time, 64 MB of float32 at 1024 dimensions
+SEARCH_BLOCK_ROWS = 16384
+# share of deleted rows above which the files are rewritten without them
+COMPACT_RATIO = 0.25
+
+
+def normalize(vectors) -> np.ndarray:
+    """Scale the rows of a matrix to unit length."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Get the indices of the k highest scores of each row, best first."""
+    k = min(k, scores.shape[1])
+    if k < scores.shape[1]:
+        indices = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indices = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, indices, axis=1), axis=1)
+    return np.take_along_axis(indices, order, axis=1)
+
+
+def search_blocks(
+    matrix: np.ndarray,
+    vectors: np.ndarray,
+    k: int,
+    dead: np.ndarray | None = None,
+    block_rows: int = SEARCH_BLOCK_ROWS,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Get the scores and row indices of the k best rows per vector, best first.
+
+    The rows are scored block by block, keeping the k best of each vector so
+    far, so only one block is upcast to float32 at a time. Rows flagged in
+    `dead` score -inf.
+    """
+    best_scores = np.empty((len(vectors), 0), dtype=np.float32)
+    best_indices = np.empty((len(vectors), 0), dtype=np.int64)
+    for start in range(0, len(matrix), block_rows):
+        block = np.asarray(matrix[start : start + block_rows], dtype=np.float32)
+        scores = vectors @ block.T
+        if dead is not None:
+            scores[:, dead[start : start + block_rows]] = -np.inf
+        indices = top_k(scores, k)
+        best_scores = np.concatenate(
+            [best_scores, np.take_along_axis(scores, indices, axis=1)], axis=1
+        )
+        best_indices = np.concatenate([best_indices, indices + start], axis=1)
+        order = top_k(best_scores, k)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_indices = np.take_along_axis(best_indices, order, axis=1)
+    return best_scores, best_indices
+
+
+class NumpyVectorStore(VectorStore):
+    """A vector store searching a memory-mapped matrix of normalized embeddings.
+
+    Scores are cosine similarities, as those of the Chroma index in cosine
+    space. `get`, `delete` and `delete_collection` behave as those of
+    Chroma, so the index can be built incrementally the same way. Writes
+    append to the files and the in-memory lists, and deletes mark rows dead
+    until the files are compacted.
+    """
+
+    def __init__(
+        self,
+        persist_directory: Path,
+        embedding_function: Embeddings,
+        dtype: str = "float32",
+    ):
+        self.persist_directory = Path(persist_directory)
+        self.embedding_function = embedding_function
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding_function
+
+    def _load(self):
+        """Open the matrix and read the sidecar files, if they exist."""
+        index_path = self.persist_directory / INDEX_FILE
+        index = json.loads(index_path.read_text()) if index_path.exists() else {}
+        self.dim = index.get("dim")
+        if index.get("dtype"):
+            self.dtype = np.dtype(index["dtype"])
+
+        self.ids, self.texts, self.metadatas = [], [], []
+        self._rows = {}
+        dead = []
+        metadata_path = self.persist_directory / METADATA_FILE
+        if metadata_path.exists():
+            with open(metadata_path) as f:
+                for line in f:
+                    row = json.loads(line)
+                    if "deleted" in row:
+                        dead.append(self._rows.pop(row["deleted"]))
+                        continue
+                    self._rows[row["id"]] = len(self.ids)
+                    self.ids.append(row["id"])
+                    self.texts.append(row["page_content"])
+                    self.metadatas.append(row["metadata"])
+        self._dead = np.zeros(len(self.ids), dtype=bool)
+        self._dead[dead] = True
+        self._map()
+
+    def _map(self):
+        """Map the rows of the matrix that the sidecar describes."""
+        self._vectors = None
+        if self.ids:
+            self._vectors = np.memmap(
+                self.persist_directory / VECTORS_FILE,
+                dtype=self.dtype,
+                mode="r",
+                shape=(len(self.ids), self.dim),
+            )
+
+    def _write_index(self):
+        index = {"dim": self.dim, "dtype": self.dtype.name, "count": len(self.ids)}
+        (self.persist_directory / INDEX_FILE).write_text(json.dumps(index))
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs) -> list[str]:
+        texts = list(texts)
+        metadatas = list(metadatas) if metadatas else [{} for _ in texts]
+        ids = list(ids) if ids else [str(uuid.uuid4()) for _ in texts]
+        if not texts:
+            return []
+        vectors = normalize(self.embedding_function.embed_documents(texts))
+
+        with self._lock:
+            # replace the rows of ids that are already in the store
+            self._delete(ids)
+            self.persist_directory.mkdir(parents=True, exist_ok=True)
+            self.dim = vectors.shape[1]
+            with open(self.persist_directory / VECTORS_FILE, "ab") as f:
+                f.write(vectors.astype(self.dtype).tobytes())
+            with open(self.persist_directory / METADATA_FILE, "a") as f:
+                for id_, text, metadata in zip(ids, texts, metadatas):
+                    row = {"id": id_, "page_content": text, "metadata": metadata}
+                    f.write(json.dumps(row) + "\n")
+
+            # searches may hold the lists, which only grow past their rows
+            for id_, text, metadata in zip(ids, texts, metadatas):
+                self._rows[id_] = len(self.ids)
+                self.ids.append(id_)
+                self.texts.append(text)
+                self.metadatas.append(metadata)
+            self._dead = np.concatenate([self._dead, np.zeros(len(ids), dtype=bool)])
+            self._write_index()
+            self._map()
+        return ids
+
+    def get(self, ids: list[str] | None = None, include=None) -> dict:
+        """Get the ids, texts and metadata of the rows of the ids that exist."""
+        with self._lock:
+            if ids is None:
+                rows = sorted(self._rows.values())
+            else:
+                rows = [self._rows[i] for i in ids if i in self._rows]
+            return {
+                "ids": [self.ids[r] for r in rows],
+                "documents": [self.texts[r] for r in rows],
+                "metadatas": [self.metadatas[r] for r in rows],
+            }
+
+    def _delete(self, ids: list[str]):
+        """Mark the rows of the ids deleted, compacting once many rows are."""
+        rows = [self._rows.pop(i) for i in dict.fromkeys(ids) if i in self._rows]
+        if not rows:
+            return
+        with open(self.persist_directory / METADATA_FILE, "a") as f:
+            for r in rows:
+                f.write(json.dumps({"deleted": self.ids[r]}) + "\n")
+        # replaced rather than changed, for the searches holding the mask
+        dead = self._dead.copy()
+        dead[rows] = True
+        self._dead = dead
+        if dead.sum() > COMPACT_RATIO * len(dead):
+            self._compact()
+
+    def _compact(self):
+        """Rewrite the files without the deleted rows, block by block."""
+        keep = np.flatnonzero(~self._dead)
+        tmp = self.persist_directory / (VECTORS_FILE + ".tmp")
+        with open(tmp, "wb") as f:
+            for start in range(0, len(keep), SEARCH_BLOCK_ROWS):
+                block = self._vectors[keep[start : start + SEARCH_BLOCK_ROWS]]
+                f.write(np.asarray(block, dtype=self.dtype).tobytes())
+        tmp_metadata = self.persist_directory / (METADATA_FILE + ".tmp")
+        with open(tmp_metadata, "w") as f:
+            for r in keep:
+                row = {
+                    "id": self.ids[r],
+                    "page_content": self.texts[r],
+                    "metadata": self.metadatas[r],
+                }
+                f.write(json.dumps(row) + "\n")
+        os.replace(tmp, self.persist_directory / VECTORS_FILE)
+        os.replace(tmp_metadata, self.persist_directory / METADATA_FILE)
+        self.ids = [self.ids[r] for r in keep]
+        self._write_index()
+        self._load()
+
+    def delete(self, ids: list[str] | None = None, **kwargs):
+        """Delete the rows of the ids.
+
+        The deletions are appended to the sidecar and the rows skipped by
+        searches; the files are rewritten once `COMPACT_RATIO` of the rows
+        are deleted.
+        """
+        with self._lock:
+            self._delete(list(ids or []))
+
+    def delete_collection(self):
+        """Delete all the files of the store."""
+        with self._lock:
+            for name in [VECTORS_FILE, METADATA_FILE, INDEX_FILE]:
+                (self.persist_directory / name).unlink(missing_ok=True)
+            self._load()
+
+    def search_by_vectors(
+        self, vectors, k: int = 4
+    ) -> list[list[tuple[Document, float]]]:
+        """Get the k most similar documents and their cosine similarity per vector.
+
+        Writes replace the matrix and the deletion mask rather than change
+        them, and only append to the sidecar lists, so searches run on a
+        snapshot taken under the lock, concurrently with each other.
+        """
+        vectors = normalize(vectors)
+        with self._lock:
+            matrix, texts, metadatas = self._vectors, self.texts, self.metadatas
+            dead = self._dead if self._dead.any() else None
+        if matrix is None:
+            return [[] for _ in vectors]
+
+        scores, indices = search_blocks(matrix, vectors, k, dead)
+        return [
+            [
+                (
+                    Document(page_content=texts[i], metadata=dict(metadatas[i])),
+                    float(score),
+                )
+                for i, score in zip(row_indices, row_scores)
+                if score > -np.inf
+            ]
+            for row_indices, row_scores in zip(indices, scores)
+        ]
+
+    def batch_similarity_search_with_score(
+        self, queries: list[str], k: int = 4
+    ) -> list[list[tuple[Document, float]]]:
+        """Search many queries with one query cache lookup and one matrix product."""
+        embeddings = self.embedding_function
+        if hasattr(embeddings, "embed_queries"):
+            vectors = embeddings.embed_queries(queries)
+        else:
+            vectors = [embeddings.embed_query(query) for query in queries]
+        return self.search_by_vectors(vectors, k)
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs):
+        vector = self.embedding_function.embed_query(query)
+        return self.search_by_vectors([vector], k)[0]
+
+    def _similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs
+    ):
+        return self.similarity_search_with_score(query, k)
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, **kwargs):
+        return [doc for doc, _ in self.search_by_vectors([embedding], k)[0]]
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs) -> list[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts,
+        embedding: Embeddings,
+        metadatas=None,
+        ids=None,
+        persist_directory: Path | None = None,
+        dtype: str = "float32",
+        **kwargs,
+    ):
+        store = cls(persist_directory, embedding, dtype=dtype)
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -0,0 +1,58 @@
+"""Grade the obviously relevant or off-topic documents without the LLM grader.
+
+A document is scored from its retrieval score and the share of the terms of
+the question it contains. Above the upper threshold it is relevant, below
+the lower one it is not, and in between it is left to the LLM grader.
+Calibrate the thresholds with `calibrate_prefilter.py`.
+"""
+
+from bm25_index import tokenize
+from config import PREFILTER_LOWER, PREFILTER_SCORE_WEIGHT, PREFILTER_UPPER
+
+
+def get_keyword_overlap(question: str, text: str) -> float:
+    """Get the share of the terms of the question, stopwords aside, in the text."""
+    terms = set(tokenize(question))
+    if not terms:
+        return 0.0
+    return len(terms & set(tokenize(text))) / len(terms)
+
+
+def get_retrieval_score(doc) -> float | None:
+    """Get the similarity score of a document, None if it has none.
+
+    With hybrid retrieval, `score` is a fused rank rather than a similarity,
+    so the score of the vector ranking is used, and a document found by the
+    keyword ranking only has none.
+    """
+    if "vector_score" in doc.metadata or "bm25_score" in doc.metadata:
+        return doc.metadata.get("vector_score")
+    return doc.metadata.get("score")
+
+
+def get_prefilter_score(
+    question: str, doc, score_weight: float = PREFILTER_SCORE_WEIGHT
+) -> float | None:
+    """Get the pre-filter score of a document, None if it has no retrieval score."""
+    score = get_retrieval_score(doc)
+    if score is None:
+        return None
+    overlap = get_keyword_overlap(question, doc.page_content)
+    return score_weight * score + (1 - score_weight) * overlap
+
+
+def prefilter_grade(
+    question: str,
+    doc,
+    lower: float = PREFILTER_LOWER,
+    upper: float = PREFILTER_UPPER,
+) -> str | None:
+    """Grade a document 'yes' or 'no' if it is clear-cut, None if uncertain."""
+    score = get_prefilter_score(question, doc)
+    if score is None:
+        return None
+    if score >= upper:
+        return "yes"
+    if score <= lower:
+        return "no"
+    return None
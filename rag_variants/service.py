@@ -0,0 +1,210 @@
+"""Serve the graph of the RAG variants over HTTP."""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+
+import agents
+import uvicorn
+from cache import normalize_text
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from graph import create_graph_rag_variant
+from loguru import logger
+from pydantic import BaseModel
+from streaming import astream_with_tokens
+from tools import get_web_search_tool
+
+# number of requests, graph executions and requests that joined an execution
+service_stats = Counter()
+
+
+class Question(BaseModel):
+    """A question for the graph."""
+
+    question: str
+
+
+class Flight:
+    """One graph execution whose progress is shared by every request for it."""
+
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self._changed = asyncio.Condition()
+
+    async def publish(self, event: dict, done: bool = False):
+        """Publish an event to every subscriber."""
+        async with self._changed:
+            self.events.append(event)
+            self.done = self.done or done
+            self._changed.notify_all()
+
+    async def subscribe(self):
+        """Yield every event of the execution, from the first one."""
+        seen = 0
+        while True:
+            async with self._changed:
+                await self._changed.wait_for(
+                    lambda: len(self.events) > seen or self.done
+                )
+                events, done = self.events[seen:], self.done
+            for event in events:
+                yield event
+            seen += len(events)
+            if done:
+                return
+
+
+class GraphService:
+    """Keeps the compiled graph warm and coalesces identical in-flight questions."""
+
+    def __init__(self):
+        self.app = None
+        self.flights = {}
+        self._tasks = set()
+
+    def warm_up(self):
+        """Compile the graph, open the vector store and build the chains."""
+        self.app = create_graph_rag_variant(use_async=True)
+        agents.get_index_retriever()
+        for getter in (
+            agents.get_rag_chain,
+            agents.get_query_router,
+            agents.get_document_grader,
+            agents.get_batch_document_grader,
+            agents.get_hallucination_grader,
+            agents.get_relevance_grader,
+        ):
+            getter()
+
+    def get_flight(self, question: str) -> Flight:
+        """Get the execution for the question, starting one if there is none."""
+        service_stats["requests"] += 1
+        key = normalize_text(question)
+
+        flight = self.flights.get(key)
+        if flight is not None:
+            service_stats["coalesced"] += 1
+            return flight
+
+        service_stats["executions"] += 1
+        flight = Flight()
+        self.flights[key] = flight
+        task = asyncio.create_task(self.run(key, question, flight))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return flight
+
+    async def run(self, key: str, question: str, flight: Flight):
+        """Run the graph for the question, publishing its tokens and finished nodes."""
+        start = time.perf_counter()
+        state = {}
+        time_to_first_token = None
+        try:
+            async for event in astream_with_tokens(
+                self.app, agents.create_inputs(question)
+            ):
+                if event["event"] == "node":
+                    state.update(event.pop("value"))
+                elif event["event"] == "token" and time_to_first_token is None:
+                    time_to_first_token = round(event["elapsed"], 3)
+                event["elapsed"] = round(event["elapsed"], 3)
+                await flight.publish(event)
+            await flight.publish(
+                {
+                    "event": "answer",
+                    "question": question,
+                    "generation": state.get("generation"),
+                    "degraded": state.get("degraded", False),
+                    "time_to_first_token": time_to_first_token,
+                    "elapsed": round(time.perf_counter() - start, 3),
+                },
+                done=True,
+            )
+        except Exception as e:
+            logger.exception(f"Graph execution failed for: {question}")
+            await flight.publish({"event": "error", "detail": str(e)}, done=True)
+        finally:
+            self.flights.pop(key, None)
+
+
+service = GraphService()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await asyncio.to_thread(service.warm_up)
+    yield
+
+
+api = FastAPI(title="RAG variants", lifespan=lifespan)
+
+
+@api.get("/health")
+async def health() -> dict:
+    return {"status": "ok"}
+
+
+@api.get("/stats")
+async def stats() -> dict:
+    return {
+        "service": dict(service_stats),
+        "in_flight": len(service.flights),
+        "grader_cache": agents.get_grader_cache().stats(),
+        "router": dict(agents.routing_stats),
+        "document_grading": dict(agents.grading_stats),
+        "grader_cascades": agents.get_cascade_stats(),
+        "degraded_paths": dict(agents.deadline_stats),
+        "web_search_cache": get_web_search_tool().stats(),
+    }
+
+
+@api.post("/ask")
+async def ask(question: Question) -> dict:
+    """Answer a question once the graph has finished."""
+    async for event in service.get_flight(question.question).subscribe():
+        if event["event"] in ("answer", "error"):
+            return event
+
+
+@api.post("/ask/stream")
+async def ask_stream(question: Question) -> StreamingResponse:
+    """Stream the tokens, finished nodes and the answer as JSON lines."""
+    flight = service.get_flight(question.question)
+
+    async def lines():
+        async for event in flight.subscribe():
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def main():
+    """Entry point."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--fake-llm",
+        action="store_true",
+        help="Serve a fake LLM, vector store and web search, for load tests",
+    )
+    parser.add_argument(
+        "--fake-latency", type=float, default=0.2, help="Latency of each fake call in s"
+    )
+    args = parser.parse_args()
+
+    if args.fake_llm:
+        from fakes import use_fakes
+
+        use_fakes(args.fake_latency)
+
+    uvicorn.run(api, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Stream the tokens of the generation out of a run of the graph."""
+
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+
+_DONE = object()
+
+_current_sink = contextvars.ContextVar("token_sink", default=None)
+
+
+class TokenSink:
+    """Collects the events of a run: tokens, retry markers and finished nodes.
+
+    Every event is a dict with its kind under `event` and the seconds since
+    the start of the run under `elapsed`.
+    """
+
+    def __init__(self, put):
+        self._put = put
+        self.start = time.perf_counter()
+        self.time_to_first_token = None
+
+    def elapsed(self) -> float:
+        """Get the seconds since the start of the run."""
+        return time.perf_counter() - self.start
+
+    def put(self, event: str, **data):
+        """Send an event to the caller."""
+        self._put({"event": event, "elapsed": self.elapsed(), **data})
+
+    def token(self, text: str):
+        """Send a token of the generation to the caller."""
+        if self.time_to_first_token is None:
+            self.time_to_first_token = self.elapsed()
+        self.put("token", text=text)
+
+
+def get_token_sink() -> TokenSink | None:
+    """Get the sink of the current run, None if its tokens are not streamed."""
+    return _current_sink.get()
+
+
+def mark_retry(reason: str):
+    """Tell the caller that the generation was rejected and starts again."""
+    sink = get_token_sink()
+    if sink is not None:
+        sink.put("retry", reason=reason)
+
+
+def stream_with_tokens(app, inputs: dict, config: dict | None = None):
+    """Run the graph, yielding the tokens and finished nodes as they are produced.
+
+    Yields `token` events with the `text` of each token of the generation,
+    `retry` events with the `reason` the generation was rejected, and `node`
+    events with the `node` name and its `value`, as `app.stream` does.
+    """
+    events = queue.Queue()
+    sink = TokenSink(events.put)
+
+    def run():
+        _current_sink.set(sink)
+        try:
+            for output in app.stream(inputs, config):
+                for node, value in output.items():
+                    sink.put("node", node=node, value=value)
+        except Exception as e:
+            events.put(e)
+        finally:
+            events.put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while (event := events.get()) is not _DONE:
+        if isinstance(event, Exception):
+            raise event
+        yield event
+    thread.join()
+
+
+async def astream_with_tokens(app, inputs: dict, config: dict | None = None):
+    """Run the async graph, yielding the tokens and finished nodes as they are produced.
+
+    The events are the same as for `stream_with_tokens`.
+    """
+    events = asyncio.Queue()
+    sink = TokenSink(events.put_nowait)
+
+    async def run():
+        _current_sink.set(sink)
+        try:
+            async for output in app.astream(inputs, config):
+                for node, value in output.items():
+                    sink.put("node", node=node, value=value)
+        except Exception as e:
+            events.put_nowait(e)
+        finally:
+            events.put_nowait(_DONE)
+
+    task = asyncio.create_task(run())
+    while (event := await events.get()) is not _DONE:
+        if isinstance(event, Exception):
+            raise event
+        yield event
+    await task
@@ -1,11 +1,100 @@
 """A collection of tools for the rag_variants package."""
 
+import asyncio
 import os
 
+from cache import SqliteCache, normalize_text
+from config import (
+    WEB_SEARCH_CACHE_ENABLED,
+    WEB_SEARCH_CACHE_MAX_ENTRIES,
+    WEB_SEARCH_CACHE_PATH,
+    WEB_SEARCH_CACHE_TTL_S,
+)
 from dotenv import load_dotenv
 from langchain_community.tools.tavily_search import TavilySearchResults
+from loguru import logger
 
 load_dotenv()
 tavily_api_key = os.getenv("TAVILY_API_KEY")
 
-web_search_tool = TavilySearchResults(k=3)
+
+class CachedWebSearch:
+    """A web search tool whose results are cached by normalized query.
+
+    Only lists of results are cached, so errors reported by the backend as
+    text are never served from the cache.
+    """
+
+    def __init__(self, backend, store: SqliteCache, enabled: bool = True):
+        self.backend = backend
+        self.store = store
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def _get_cached(self, query: str) -> list | None:
+        if not self.enabled:
+            return None
+        results = self.store.get(normalize_text(query))
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            logger.info("=== Web search results served from the cache ===")
+        return results
+
+    def _set_cached(self, query: str, results):
+        if self.enabled and isinstance(results, list):
+            self.store.set(normalize_text(query), results)
+
+    def invoke(self, input: dict):
+        """Search the web for `input["query"]`."""
+        results = self._get_cached(input["query"])
+        if results is None:
+            results = self.backend.invoke(input)
+            self._set_cached(input["query"], results)
+        return results
+
+    async def ainvoke(self, input: dict):
+        """Search the web for `input["query"]`.
+
+        The cache is read and written in a thread, off the event loop.
+        """
+        results = await asyncio.to_thread(self._get_cached, input["query"])
+        if results is None:
+            results = await self.backend.ainvoke(input)
+            await asyncio.to_thread(self._set_cached, input["query"], results)
+        return results
+
+    def stats(self) -> dict:
+        """Get the hits and misses of the cache."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+_web_search_backend = None
+_web_search_tool = None
+
+
+def get_web_search_tool() -> CachedWebSearch:
+    """Get the cached web search tool, creating it on first use."""
+    global _web_search_backend, _web_search_tool
+    if _web_search_tool is None:
+        if _web_search_backend is None:
+            _web_search_backend = TavilySearchResults(k=3)
+        store = SqliteCache(
+            WEB_SEARCH_CACHE_PATH,
+            table="results",
+            max_entries=WEB_SEARCH_CACHE_MAX_ENTRIES,
+            ttl_seconds=WEB_SEARCH_CACHE_TTL_S,
+        )
+        _web_search_tool = CachedWebSearch(
+            _web_search_backend, store, enabled=WEB_SEARCH_CACHE_ENABLED
+        )
+    return _web_search_tool
+
+
+def set_web_search_tool(tool):
+    """Replace the backend of the web search tool, e.g. with a stub for offline runs."""
+    global _web_search_backend, _web_search_tool
+    _web_search_backend = tool
+    _web_search_tool = None
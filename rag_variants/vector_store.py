@@ -1,42 +1,664 @@
 """Create a vector store for the RAG variants."""
 
+import asyncio
+import functools
+import hashlib
+import json
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+
+import tiktoken
+from bm25_index import BM25Index
+from cache import EmbeddingStore, content_hash
+from config import (
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+    COLLECTION_NAME,
+    EMBEDDING_BATCH_SIZE,
+    EMBEDDING_CACHE_ENABLED,
+    EMBEDDING_CACHE_PATH,
+    EMBEDDING_MODEL,
+    HYBRID_BM25_K,
+    HYBRID_VECTOR_K,
+    INDEX_DIR,
+    INDEX_URLS,
+    PARSE_POOL_MIN_PAGES,
+    PARSE_PROCESSES,
+    RETRIEVAL_K,
+    RRF_K,
+    TOKEN_ENCODING,
+    VECTOR_BACKEND,
+    VECTOR_DTYPE,
+)
 from dotenv import load_dotenv
+from fetcher import PageCache, fetch_pages, parse_pages
+from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.document_loaders import WebBaseLoader
 from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStore
 from langchain_mistralai import MistralAIEmbeddings
+from loguru import logger
 
 load_dotenv()
 
-
-def get_doc_from_url(url: str):
-    """Get document from a URL."""
-    return WebBaseLoader(url).load()
+MANIFEST_FILE = "manifest.json"
+BM25_FILE = "bm25.sqlite"
+# relevance scores are cosine similarities with either backend, so that the
+# router and pre-filter thresholds mean the same with both
+DISTANCE = "cosine"
 
 
-def get_text_splitter(chunk_size: int = 250, chunk_overlap: int = 0):
+def get_text_splitter(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
     """Get a text splitter."""
     return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        encoding_name=TOKEN_ENCODING, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_encoder():
+    """Get the tiktoken encoder used by the text splitter."""
+    return tiktoken.get_encoding(TOKEN_ENCODING)
+
+
+def count_tokens(text: str) -> int:
+    """Count the tokens of a text as the text splitter does."""
+    return len(get_token_encoder().encode(text))
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings cached on disk, keyed on the model and the hash of the text.
+
+    Only the texts missing from the cache are embedded, in batches of
+    `batch_size` texts. Queries are cached apart from documents, as models
+    may embed them differently.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model: str,
+        store: EmbeddingStore,
+        batch_size: int = EMBEDDING_BATCH_SIZE,
+        enabled: bool = True,
+    ):
+        self.embeddings = embeddings
+        self.model = model
+        self.store = store
+        self.batch_size = batch_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def _get_cached(self, model: str, texts: list[str]) -> tuple[list, dict, dict]:
+        """Get the hashes of the texts, the cached vectors and the missing texts."""
+        hashes = [content_hash(text) for text in texts]
+        cached = self.store.get_many(model, set(hashes)) if self.enabled else {}
+        missing = {h: text for h, text in zip(hashes, texts) if h not in cached}
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return hashes, cached, missing
+
+    def _get_batches(self, missing: dict) -> list[dict]:
+        items = list(missing.items())
+        return [
+            dict(items[i : i + self.batch_size])
+            for i in range(0, len(items), self.batch_size)
+        ]
+
+    def _store(self, model: str, cached: dict, batch: dict, vectors: list):
+        new = dict(zip(batch, vectors))
+        if self.enabled:
+            self.store.set_many(model, new)
+        cached.update(new)
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes, cached, missing = self._get_cached(self.model, texts)
+        for batch in self._get_batches(missing):
+            vectors = self.embeddings.embed_documents(list(batch.values()))
+            self._store(self.model, cached, batch, vectors)
+        return [cached[h] for h in hashes]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        hashes, cached, missing = self._get_cached(self.model, texts)
+        for batch in self._get_batches(missing):
+            vectors = await self.embeddings.aembed_documents(list(batch.values()))
+            self._store(self.model, cached, batch, vectors)
+        return [cached[h] for h in hashes]
+
+    def embed_query(self, text: str) -> list[float]:
+        model = f"{self.model}#query"
+        hashes, cached, missing = self._get_cached(model, [text])
+        if missing:
+            self._store(model, cached, missing, [self.embeddings.embed_query(text)])
+        return cached[hashes[0]]
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """Embed many queries, looking them up in the query cache at once.
+
+        The queries missing from the cache are embedded with `embed_query`, as
+        embeddings have no batched query call.
+        """
+        model = f"{self.model}#query"
+        hashes, cached, missing = self._get_cached(model, texts)
+        if missing:
+            vectors = [self.embeddings.embed_query(text) for text in missing.values()]
+            self._store(model, cached, missing, vectors)
+        return [cached[h] for h in hashes]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        model = f"{self.model}#query"
+        hashes, cached, missing = self._get_cached(model, [text])
+        if missing:
+            vector = await self.embeddings.aembed_query(text)
+            self._store(model, cached, missing, [vector])
+        return cached[hashes[0]]
+
+    def stats(self) -> dict:
+        """Get the hits and misses of the cache, in texts."""
+        return {"hits": self.hits, "misses": self.misses}
+
+
+@functools.lru_cache(maxsize=None)
+def get_embedding_store() -> EmbeddingStore:
+    """Get the shared store of cached embeddings."""
+    return EmbeddingStore(EMBEDDING_CACHE_PATH)
+
+
+@functools.lru_cache(maxsize=None)
+def get_embeddings(model: str = EMBEDDING_MODEL) -> CachedEmbeddings:
+    """Get the embedding model, behind the embedding cache."""
+    return CachedEmbeddings(
+        MistralAIEmbeddings(model=model),
+        model,
+        get_embedding_store(),
+        enabled=EMBEDDING_CACHE_ENABLED,
+    )
+
+
+def get_content_hash(docs: list) -> str:
+    """Get a sha256 hash of the content of the documents loaded from a URL."""
+    sha = hashlib.sha256()
+    for doc in docs:
+        sha.update(doc.page_content.encode("utf-8"))
+    return sha.hexdigest()
+
+
+def get_index_settings(
+    chunk_size: int,
+    chunk_overlap: int,
+    embedding_model: str,
+    backend: str = VECTOR_BACKEND,
+    dtype: str = VECTOR_DTYPE,
+) -> dict:
+    """Get the settings that determine how the pages of an index are embedded.
+
+    The dtype only applies to the NumPy backend.
+    """
+    return {
+        "backend": backend,
+        "dtype": dtype if backend == "numpy" else None,
+        "distance": DISTANCE,
+        "collection_name": COLLECTION_NAME,
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embedding_model": embedding_model,
+    }
+
+
+def read_manifest(persist_directory: Path) -> dict | None:
+    """Read the manifest of a persisted index, if there is one."""
+    manifest_path = Path(persist_directory) / MANIFEST_FILE
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_manifest(persist_directory: Path, manifest: dict):
+    """Write the manifest of a persisted index."""
+    manifest_path = Path(persist_directory) / MANIFEST_FILE
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def open_vector_store(
+    persist_directory: Path = INDEX_DIR,
+    embedding_model: str = EMBEDDING_MODEL,
+    backend: str = VECTOR_BACKEND,
+):
+    """Open a persisted vector store without touching its content."""
+    if backend == "numpy":
+        from numpy_index import NumpyVectorStore
+
+        return NumpyVectorStore(
+            persist_directory, get_embeddings(embedding_model), dtype=VECTOR_DTYPE
+        )
+    return Chroma(
+        collection_name=COLLECTION_NAME,
+        embedding_function=get_embeddings(embedding_model),
+        persist_directory=str(persist_directory),
+        collection_metadata={"hnsw:space": DISTANCE},
+    )
+
+
+def delete_index(persist_directory: Path, manifest: dict):
+    """Delete the collection of a persisted index and its manifest."""
+    logger.info(f"Deleting index in {persist_directory}")
+    settings = manifest["settings"]
+    open_vector_store(
+        persist_directory,
+        settings["embedding_model"],
+        settings.get("backend", "chroma"),
+    ).delete_collection()
+    open_bm25_index(persist_directory).clear()
+    (Path(persist_directory) / MANIFEST_FILE).unlink()
+
+
+def open_bm25_index(persist_directory: Path = INDEX_DIR) -> BM25Index:
+    """Open the keyword index kept next to a persisted vector store."""
+    return BM25Index(Path(persist_directory) / BM25_FILE)
+
+
+def fill_bm25_index(bm25_index: BM25Index, vector_store) -> BM25Index:
+    """Index the chunks of a vector store into an empty keyword index."""
+    if len(bm25_index) == 0:
+        chunks = vector_store.get(include=["documents", "metadatas"])
+        documents = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(chunks["documents"], chunks["metadatas"])
+        ]
+        bm25_index.add(documents, chunks["ids"])
+        logger.info(f"Indexed {len(documents)} chunks for keyword search")
+    return bm25_index
+
+
+def get_chunk_id(chunk) -> str:
+    """Get the id of a chunk, the hash of its source and content."""
+    return content_hash(f"{chunk.metadata.get('source')}\x1f{chunk.page_content}")
+
+
+# text splitter of a worker process of `split_pages`
+_worker_splitter = None
+
+
+def init_split_worker(chunk_size: int, chunk_overlap: int):
+    """Build the text splitter, and so the token encoder, of a worker process."""
+    global _worker_splitter
+    _worker_splitter = get_text_splitter(chunk_size, chunk_overlap)
+
+
+def split_page(url: str, docs: list) -> tuple[str, list]:
+    """Split the documents of a page in a worker process."""
+    return url, _worker_splitter.split_documents(docs)
+
+
+def split_pages(
+    pages: dict[str, list],
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    processes: int | None = PARSE_PROCESSES,
+    min_pool_pages: int = PARSE_POOL_MIN_PAGES,
+):
+    """Split the pages into chunks, yielding each page as soon as it is split.
+
+    From `min_pool_pages` pages on, the pages are split in a pool of
+    processes, each with its own splitter and token encoder.
+    """
+    if len(pages) < min_pool_pages:
+        text_splitter = get_text_splitter(chunk_size, chunk_overlap)
+        for url, docs in pages.items():
+            yield url, text_splitter.split_documents(docs)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=processes or None,
+        initializer=init_split_worker,
+        initargs=(chunk_size, chunk_overlap),
+    ) as pool:
+        futures = [pool.submit(split_page, url, docs) for url, docs in pages.items()]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class ChunkWriter:
+    """Adds chunks to a vector store in batches, whatever page they come from."""
+
+    def __init__(self, vector_store, batch_size: int = EMBEDDING_BATCH_SIZE):
+        self.vector_store = vector_store
+        self.batch_size = batch_size
+        self.pending = {}
+        self.added = 0
+
+    def add(self, chunks: dict):
+        """Add the chunks by id, embedding them once a batch is full."""
+        self.pending.update(chunks)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Embed and add the pending chunks."""
+        if self.pending:
+            self.vector_store.add_documents(
+                list(self.pending.values()), ids=list(self.pending)
+            )
+            self.added += len(self.pending)
+            self.pending = {}
+
+
+def upsert_page(
+    vector_store,
+    bm25_index: BM25Index,
+    writer: ChunkWriter,
+    url: str,
+    docs: list,
+    chunks: list,
+    known: dict | None,
+):
+    """Upsert the chunks of a page, returning its entry in the manifest.
+
+    Only the chunks whose id is not in the vector store yet are embedded, and
+    the chunks the page no longer has are deleted, from both indexes.
+    """
+    chunks = {get_chunk_id(chunk): chunk for chunk in chunks}
+    existing = (
+        set(vector_store.get(ids=list(chunks), include=[])["ids"]) if chunks else set()
+    )
+    new_ids = [chunk_id for chunk_id in chunks if chunk_id not in existing]
+    writer.add({chunk_id: chunks[chunk_id] for chunk_id in new_ids})
+    bm25_index.add(list(chunks.values()), list(chunks))
+
+    stale_ids = set(known["chunk_ids"]) - set(chunks) if known else set()
+    if stale_ids:
+        vector_store.delete(ids=list(stale_ids))
+        bm25_index.delete(list(stale_ids))
+
+    logger.info(
+        f"Upserted {url}: {len(new_ids)} new, {len(chunks) - len(new_ids)} kept, "
+        f"{len(stale_ids)} deleted chunks"
+    )
+    return {"url": url, "sha256": get_content_hash(docs), "chunk_ids": list(chunks)}
+
+
+def delete_page(vector_store, bm25_index: BM25Index, known: dict):
+    """Delete the chunks of a page from both indexes."""
+    if known["chunk_ids"]:
+        vector_store.delete(ids=known["chunk_ids"])
+        bm25_index.delete(known["chunk_ids"])
+    logger.info(f"Deleted {known['url']}: {len(known['chunk_ids'])} chunks")
+
+
+def is_manifest_usable(manifest: dict | None, settings: dict) -> bool:
+    """Check that an index can be updated in place with the settings."""
+    return (
+        manifest is not None
+        and manifest["settings"] == settings
+        and all("chunk_ids" in entry for entry in manifest["documents"])
     )
 
 
-def create_vector_store_from_web_docs(urls: list[str], text_splitter):
-    """Create a vector store from the documents."""
-    docs = [get_doc_from_url(url) for url in urls]
+def update_vector_store(
+    urls: list[str],
+    persist_directory: Path,
+    chunk_size: int,
+    chunk_overlap: int,
+    embedding_model: str,
+    remove_missing: bool,
+):
+    """Fetch the pages of the URLs and upsert those that have changed.
+
+    The pages are fetched concurrently with conditional GETs, and those the
+    server reports unchanged are not parsed again. The pages that fail to
+    fetch keep their entry and chunks, and are fetched again next time.
 
-    docs_list = [item for sublist in docs for item in sublist]
-    doc_splits = text_splitter.split_documents(docs_list)
+    With `remove_missing`, the pages of the index that are not in `urls` are
+    deleted; otherwise they are kept as they are.
+    """
+    persist_directory = Path(persist_directory)
+    settings = get_index_settings(chunk_size, chunk_overlap, embedding_model)
 
-    vector_store = Chroma.from_documents(
-        documents=doc_splits,
-        collection_name="test-collection-mistral-embeddings",
-        embedding=MistralAIEmbeddings(),
+    manifest = read_manifest(persist_directory)
+    if manifest is not None and not is_manifest_usable(manifest, settings):
+        delete_index(persist_directory, manifest)
+        manifest = None
+    known = {entry["url"]: entry for entry in manifest["documents"]} if manifest else {}
+
+    persist_directory.mkdir(parents=True, exist_ok=True)
+    vector_store = open_vector_store(persist_directory, embedding_model)
+    bm25_index = fill_bm25_index(open_bm25_index(persist_directory), vector_store)
+
+    page_cache = PageCache()
+    pages = asyncio.run(fetch_pages(urls, page_cache))
+    docs_by_url = parse_pages(
+        [page for url, page in pages.items() if page.changed or url not in known]
     )
 
+    entries = {} if remove_missing else dict(known)
+    changed = {}
+    for url in urls:
+        if url not in pages:
+            if url in known:
+                entries[url] = known[url]
+            continue
+        docs = docs_by_url.get(url)
+        # not modified since the last fetch, or modified to the same content
+        unchanged = (
+            docs is None
+            or url in known
+            and (get_content_hash(docs) == known[url]["sha256"])
+        )
+        if unchanged:
+            entries[url] = known[url]
+        else:
+            changed[url] = docs
+
+    # the chunks of each page are embedded in batches as soon as it is split
+    writer = ChunkWriter(vector_store)
+    num_chunks = 0
+    start = time.perf_counter()
+    for url, chunks in split_pages(changed, chunk_size, chunk_overlap):
+        entries[url] = upsert_page(
+            vector_store, bm25_index, writer, url, changed[url], chunks, known.get(url)
+        )
+        num_chunks += len(chunks)
+    writer.flush()
+    if changed:
+        elapsed = time.perf_counter() - start
+        logger.info(
+            f"Split {len(changed)} pages into {num_chunks} chunks, embedded "
+            f"{writer.added} new ones in {elapsed:.1f}s "
+            f"({num_chunks / elapsed:.0f} chunks/s)"
+        )
+
+    for url in set(known) - set(entries):
+        delete_page(vector_store, bm25_index, known[url])
+
+    write_manifest(
+        persist_directory,
+        {
+            "settings": settings,
+            "documents": list(entries.values()),
+            "num_chunks": sum(len(e["chunk_ids"]) for e in entries.values()),
+            "built_at": datetime.now(timezone.utc).isoformat(),
+        },
+    )
+    # only now that the index holds the pages may the server skip them
+    page_cache.save(list(pages.values()))
     return vector_store
 
 
-def get_retriever(vector_store):
-    """Get a retriever from the vector store."""
-    return vector_store.as_retriever()
+def build_vector_store(
+    urls: list[str] = INDEX_URLS,
+    persist_directory: Path = INDEX_DIR,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    embedding_model: str = EMBEDDING_MODEL,
+    force: bool = False,
+):
+    """Refresh a persisted vector store so that it holds exactly the pages of the URLs.
+
+    The pages are fetched so that their content hashes can be compared
+    against the manifest, skipping those the server reports unchanged. Only
+    the chunks of new or changed pages that are not in the index yet are
+    embedded, and the chunks of removed pages are deleted.
+    The index is rebuilt from scratch with `force` or when the settings have
+    changed.
+    """
+    manifest = read_manifest(persist_directory)
+    if force and manifest is not None:
+        delete_index(persist_directory, manifest)
+
+    return update_vector_store(
+        urls,
+        persist_directory,
+        chunk_size,
+        chunk_overlap,
+        embedding_model,
+        remove_missing=True,
+    )
+
+
+def add_urls(
+    urls: list[str],
+    persist_directory: Path = INDEX_DIR,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    embedding_model: str = EMBEDDING_MODEL,
+):
+    """Add the pages of the URLs to a persisted vector store, or refresh them.
+
+    Only these pages are fetched; the other pages of the index are kept.
+    """
+    return update_vector_store(
+        urls,
+        persist_directory,
+        chunk_size,
+        chunk_overlap,
+        embedding_model,
+        remove_missing=False,
+    )
+
+
+def load_vector_store(
+    urls: list[str] = INDEX_URLS,
+    persist_directory: Path = INDEX_DIR,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    embedding_model: str = EMBEDDING_MODEL,
+):
+    """Open the persisted vector store, updating it if it misses pages or settings.
+
+    Only the manifest is compared, so opening an index that has every URL
+    needs no network access; pages added with `add_urls` are kept. Use
+    `build_index.py` to pick up changes in the content of the pages.
+    """
+    settings = get_index_settings(chunk_size, chunk_overlap, embedding_model)
+    manifest = read_manifest(persist_directory)
+
+    if is_manifest_usable(manifest, settings):
+        indexed = {entry["url"] for entry in manifest["documents"]}
+        missing = [url for url in urls if url not in indexed]
+        if not missing:
+            logger.info(f"Opening persisted index in {persist_directory}")
+            return open_vector_store(persist_directory, embedding_model)
+        logger.info(f"Adding {len(missing)} missing pages to {persist_directory}")
+        return add_urls(
+            missing, persist_directory, chunk_size, chunk_overlap, embedding_model
+        )
+
+    logger.info(f"No matching index in {persist_directory}, building it")
+    return build_vector_store(
+        urls, persist_directory, chunk_size, chunk_overlap, embedding_model
+    )
+
+
+class ScoredRetriever(BaseRetriever):
+    """A retriever keeping the relevance score of each document in its metadata."""
+
+    vector_store: VectorStore
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> list:
+        docs_and_scores = self.vector_store.similarity_search_with_relevance_scores(
+            query, k=self.k
+        )
+        return add_scores_to_metadata(docs_and_scores)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager) -> list:
+        docs_and_scores = (
+            await self.vector_store.asimilarity_search_with_relevance_scores(
+                query, k=self.k
+            )
+        )
+        return add_scores_to_metadata(docs_and_scores)
+
+
+def add_scores_to_metadata(docs_and_scores: list) -> list:
+    """Keep the score of each document under `score` in its metadata."""
+    for doc, score in docs_and_scores:
+        doc.metadata["score"] = score
+    return [doc for doc, _ in docs_and_scores]
+
+
+class HybridRetriever(BaseRetriever):
+    """A retriever fusing the vector and keyword (BM25) rankings of the chunks.
+
+    The rankings are fused by reciprocal rank fusion: each chunk scores
+    `1 / (rrf_k + rank)` in each ranking it appears in. The fused score is
+    kept under `score` in the metadata, and the scores of each ranking under
+    `vector_score` and `bm25_score`.
+    """
+
+    vector_store: VectorStore
+    bm25_index: BM25Index
+    k: int = RETRIEVAL_K
+    vector_k: int = HYBRID_VECTOR_K
+    bm25_k: int = HYBRID_BM25_K
+    rrf_k: int = RRF_K
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _fuse(self, vector_results: list, bm25_results: list) -> list:
+        docs, scores = {}, defaultdict(float)
+        for name, results in [("vector", vector_results), ("bm25", bm25_results)]:
+            for rank, (doc, score) in enumerate(results, start=1):
+                chunk_id = get_chunk_id(doc)
+                docs.setdefault(chunk_id, doc).metadata[f"{name}_score"] = score
+                scores[chunk_id] += 1 / (self.rrf_k + rank)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[: self.k]
+        for chunk_id in ranked:
+            docs[chunk_id].metadata["score"] = scores[chunk_id]
+        return [docs[chunk_id] for chunk_id in ranked]
+
+    def _get_relevant_documents(self, query: str, *, run_manager) -> list:
+        vector_results = self.vector_store.similarity_search_with_relevance_scores(
+            query, k=self.vector_k
+        )
+        bm25_results = self.bm25_index.search(query, k=self.bm25_k)
+        return self._fuse(vector_results, bm25_results)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager) -> list:
+        vector_results, bm25_results = await asyncio.gather(
+            self.vector_store.asimilarity_search_with_relevance_scores(
+                query, k=self.vector_k
+            ),
+            asyncio.to_thread(self.bm25_index.search, query, self.bm25_k),
+        )
+        return self._fuse(vector_results, bm25_results)
+
+
+def get_retriever(vector_store, bm25_index: BM25Index | None = None):
+    """Get a retriever from the vector store, of either backend.
+
+    With a keyword index, the retriever is hybrid.
+    """
+    if bm25_index is not None:
+        return HybridRetriever(vector_store=vector_store, bm25_index=bm25_index)
+    return ScoredRetriever(vector_store=vector_store, k=RETRIEVAL_K)